@@ -5,18 +5,33 @@
 import os
 import os.path as op
 import re
+import hashlib
+import time
+import threading
+import socket
+import socketserver
+import struct
+from itertools import count
+from tempfile import TemporaryDirectory
+from contextlib import contextmanager
 from io import BytesIO
 import shutil
 from datetime import date as Date
 from copy import deepcopy
 import json
-from subprocess import check_call, check_output
+import mmap
+import sqlite3
+import sys
+from subprocess import check_call, CalledProcessError
 from fnmatch import fnmatch
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 import yaml
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
 from nameparser import HumanName
 
 
@@ -24,6 +39,35 @@ CONFIG_BASENAME = 'amusic_config.yml'
 PARAMS_EXT = '.json'
 FBASE2FOLDER = re.compile(r'([A-Za-z_]+)[\d]')
 DATE_FMT = '%Y-%m-%d'
+MANIFEST_BASENAME = '.amusic_manifest.json'
+PARTIAL_EXT = '.partial'
+# Modification time tolerance in seconds; FAT filesystems (as on many
+# devices) store modification times with 2 second resolution.
+MTIME_TOL = 2
+HASH_BLOCK = 2 ** 20
+# Key in output params for hash of output file.
+OUT_HASH_KEY = 'out_md5'
+IMPORT_EXTS = ('.flac', '.mp3')
+# Input audio files to check for duplicates.
+AUDIO_EXTS = ('.wav', '.aif', '.aiff') + IMPORT_EXTS
+WORKER_PORT = 8765
+# Seconds to wait for HTTP servers.
+HTTP_TIMEOUT = 60
+# Album art file written to each output folder, for "album_art" settings
+# other than "embed".
+OUT_COVER_BASENAME = 'cover.jpg'
+ALBUM_ART_MODES = ('embed', 'thumb', 'none')
+CATALOG_BASENAME = 'catalog.sqlite'
+DUMP_INDEX_EXT = '.idx'
+# Index records are release id, padded to DUMP_KEY_WIDTH bytes, and offset,
+# with fixed size and byte order, so indices are portable.
+DUMP_KEY_WIDTH = 40
+DUMP_RECORD = struct.Struct(f'<{DUMP_KEY_WIDTH}sQ')
+# Fields indexed in catalog, for queries.
+CATALOG_KEYS = ('album', 'albumartist', 'artist', 'composer', 'conductor',
+                'orchestra', 'performer', 'period', 'style', 'title')
+# Image files to use for album art, if audio files have no embedded art.
+COVER_BASENAMES = ('cover.jpg', 'folder.jpg', 'front.jpg')
 
 
 DEF_TRACK_CONFIG = {
@@ -56,6 +100,118 @@ DEFAULT_TRACK_CONFIG = {
     'style': 'Choral'}
 
 
+class Metrics:
+    """ Collect counters and timings for build steps
+
+    Counters are exported in Prometheus textfile format with `write_prom`.
+    If `jsonl_fname` is not None, we also append one JSON line per event to
+    this file.  Rates are for the run since the last call to `start`.
+    """
+
+    prefix = 'amusic'
+
+    def __init__(self, jsonl_fname=None):
+        self.jsonl_fname = jsonl_fname
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+        self.start()
+
+    def start(self):
+        """ Start a new run, such as a build, for elapsed time and rates
+        """
+        with self._lock:
+            self.start_time = time.time()
+            self.start_counters = dict(self.counters)
+
+    def since_start(self, name):
+        """ Increase in counter `name` since last call to `start`
+        """
+        with self._lock:
+            return (self.counters.get(name, 0) -
+                    self.start_counters.get(name, 0))
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def hit(self, name, is_hit):
+        """ Count hit or miss for check `name`, return `is_hit`
+        """
+        self.incr(name + ('_hits' if is_hit else '_misses'))
+        return is_hit
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.incr(name + '_seconds', time.perf_counter() - start)
+
+    def event(self, kind, **fields):
+        if self.jsonl_fname is None:
+            return
+        line = dict2json(dict(event=kind, time=time.time(), **fields))
+        with self._lock, open(self.jsonl_fname, 'at') as fobj:
+            fobj.write(line + '\n')
+
+    def gauges(self):
+        """ Values derived from counters
+        """
+        counters = dict(self.counters)
+        elapsed = time.time() - self.start_time
+        n_built = self.since_start('tracks_built')
+        out = {'elapsed_seconds': elapsed,
+               'tracks_per_second': n_built / elapsed if elapsed else 0}
+        for name in counters:
+            if not name.endswith('_hits'):
+                continue
+            root = name[:-len('_hits')]
+            n_hits = counters[name]
+            n_total = n_hits + counters.get(root + '_misses', 0)
+            out[root + '_hit_rate'] = n_hits / n_total
+        return out
+
+    def prom_text(self):
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            metric = f'{self.prefix}_{name}_total'
+            lines += [f'# TYPE {metric} counter', f'{metric} {value}']
+        for name, value in sorted(self.gauges().items()):
+            metric = f'{self.prefix}_{name}'
+            lines += [f'# TYPE {metric} gauge', f'{metric} {value}']
+        return '\n'.join(lines) + '\n'
+
+    def write_prom(self, fname):
+        # Write then rename; textfile collector may read at any time.
+        tmp_fname = fname + '.tmp'
+        with open(tmp_fname, 'wt') as fobj:
+            fobj.write(self.prom_text())
+        os.replace(tmp_fname, fname)
+
+
+# Collector for this process.
+METRICS = Metrics()
+
+
+def http_get(url, **kwargs):
+    """ Return content of `url` as bytes
+
+    Raises ``requests.HTTPError`` for error status codes.
+    """
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+    METRICS.incr('http_requests')
+    with METRICS.timer('http'):
+        response = requests.get(url, **kwargs)
+    METRICS.event('http', url=url, status=response.status_code)
+    response.raise_for_status()
+    return response.content
+
+
 def read_config(config_fname):
     """ Read, process config file `config_fname`
 
@@ -74,12 +230,98 @@ def read_config(config_fname):
     return res
 
 
+# Key in config for album blocks.
+ALBUMS_KEY = 'albums'
+# Key in album block for track entries.
+ALBUM_TRACKS_KEY = 'tracks'
+
+
+def default_settings(settings):
+    """ Default values for settings not in `settings`
+    """
+    return {
+        'min_img_size': [640, 480],
+        'n_workers': 4,
+        'conv_cache_mb': None,
+        'album_art': 'embed',
+        'thumb_dim': 300,
+        'catalog_fname': op.join(settings['conv_path'], CATALOG_BASENAME),
+    }
+
+
+def resolve_albums(albums):
+    """ Track entries from album blocks
+
+    Each album block has values shared by all its tracks, and a "tracks"
+    dictionary, with track keys and dictionaries of values specific to that
+    track (which override album values) as values.
+
+    Parameters
+    ----------
+    albums : dict
+        Album blocks, keyed by album name.
+
+    Returns
+    -------
+    tracks : dict
+        Track entries, keyed by track (input filename).
+    """
+    tracks = {}
+    for album in albums.values():
+        common = {k: v for k, v in album.items() if k != ALBUM_TRACKS_KEY}
+        for fbase, delta in album[ALBUM_TRACKS_KEY].items():
+            tracks[fbase] = {**common, **(delta or {})}
+    return tracks
+
+
+def group_albums(tracks, min_tracks=2):
+    """ Split `tracks` into album blocks and other tracks
+
+    Tracks with the same (or guessed) folder name go into an album block,
+    with the values shared by all tracks in the album, so each track only
+    needs its own values.  This is the reverse of `resolve_albums`.
+
+    Returns
+    -------
+    albums : dict
+        Album blocks, keyed by folder name.
+    singles : dict
+        Tracks not in an album block.
+    """
+    by_folder = {}
+    for fbase, entry in tracks.items():
+        folder = entry.get('folder_name') or guess_folder(fbase)
+        by_folder.setdefault(folder, []).append(fbase)
+    albums, singles = {}, {}
+    for folder, fbases in by_folder.items():
+        if folder is None or len(fbases) < min_tracks:
+            singles.update({fbase: tracks[fbase] for fbase in fbases})
+            continue
+        entries = [tracks[fbase] for fbase in fbases]
+        common = {k: v for k, v in entries[0].items()
+                  if all(k in e and e[k] == v for e in entries[1:])}
+        album = dict(common)
+        album[ALBUM_TRACKS_KEY] = {
+            fbase: {k: v for k, v in tracks[fbase].items()
+                    if k not in common}
+            for fbase in fbases}
+        albums[folder] = album
+    return albums, singles
+
+
 def proc_config(config, config_path):
     config_path = op.abspath(config_path)
-    tracks = deepcopy(config)
-    settings = tracks.pop('settings')
-    if 'min_img_size' not in settings:
-        settings['min_img_size'] = (640, 480)
+    settings = deepcopy(config['settings'])
+    for key, value in default_settings(settings).items():
+        if key not in settings:
+            settings[key] = value
+    if settings['album_art'] not in ALBUM_ART_MODES:
+        raise ValueError('album_art should be one of ' +
+                         ', '.join(ALBUM_ART_MODES))
+    tracks = {k: v for k, v in config.items()
+              if k not in ('settings', ALBUMS_KEY)}
+    # Resolve album values once per album.
+    tracks.update(resolve_albums(config.get(ALBUMS_KEY, {})))
     return settings, tracks
 
 
@@ -92,6 +334,8 @@ def resize_img(img, target_res=1024):
 
 
 def find_file(fbase, paths):
+    if fbase is None:
+        raise RuntimeError('No filename given; check config')
     search_paths = ['.'] + paths
     for dn in search_paths:
         fname = op.join(dn, fbase)
@@ -128,10 +372,13 @@ def clear_params(path):
 def stored_params_for(fname, tdelta=-1):
     params_fname = params_fname_for(fname)
     if not op.isfile(params_fname):
+        METRICS.hit('stored_params', False)
         return None
     earliest_params_time = op.getmtime(fname) + tdelta
     if op.getmtime(params_fname) < earliest_params_time:
+        METRICS.hit('stored_params', False)
         return None
+    METRICS.hit('stored_params', True)
     with open(params_fname, 'rt') as fobj:
         return json.loads(fobj.read())
 
@@ -140,10 +387,13 @@ def _obj2jobj(obj):
     return obj.strftime(DATE_FMT)
 
 
+def hash_params_for(in_fname):
+    # Trailing newline matches output of `md5 -q`, used previously.
+    return {'md5': file_md5(in_fname) + '\n'}
+
+
 def write_hash_for_fname(in_fname):
-    md5sum = check_output(['md5', '-q', in_fname],
-                          text=True)
-    params = {'md5': md5sum}
+    params = hash_params_for(in_fname)
     write_params_for(params, in_fname)
     return params
 
@@ -162,39 +412,687 @@ def write_params_for(params, out_fname, tdelta=1):
     os.utime(params_fname, (mtime, mtime))
 
 
-def convert_file(in_fname, out_fname, sox_params):
-    if (in_params := stored_params_for(in_fname)) == None:
+def convert_file(in_fname, out_fname, sox_params, encoder=None, store=None,
+                 params_getter=stored_params_for):
+    if (in_params := params_getter(in_fname)) == None:
         in_params = write_hash_for_fname(in_fname)
     params = dict(in_params=in_params, sox_params=sox_params)
-    if stored_params_for(out_fname) == params:
+    if METRICS.hit('conversion', params_getter(out_fname) == params):
+        return params
+    store_key = (conv_key_for(in_params, sox_params) +
+                 op.splitext(out_fname)[1])
+    if store is not None and store.get_file(store_key, out_fname):
+        write_params_for(params, out_fname)
         return params
     extra_params = [str(p) for p in sox_params]
-    check_call(['sox', in_fname] + extra_params + [out_fname])
+    start = time.perf_counter()
+    with METRICS.timer('sox'):
+        if encoder is None:
+            check_call(['sox', in_fname] + extra_params + [out_fname])
+        else:
+            encoder.convert(in_fname, out_fname, extra_params,
+                            in_params['md5'].strip())
+    n_bytes = op.getsize(out_fname)
+    METRICS.incr('bytes_encoded', n_bytes)
+    METRICS.event('convert', in_fname=in_fname, out_fname=out_fname,
+                  bytes=n_bytes, seconds=time.perf_counter() - start)
+    if store is not None:
+        store.put_file(store_key, out_fname)
     write_params_for(params, out_fname)
     return params
 
 
+def conv_key_for(in_params, sox_params):
+    """ Cache key for conversion of input with `in_params` using `sox_params`
+    """
+    return hashlib.md5(dict2json(dict(
+        in_params=in_params,
+        sox_params=[str(p) for p in sox_params])).encode()).hexdigest()
+
+
+def conv_fname_for(in_fname, settings, params_getter=stored_params_for):
+    if (in_params := params_getter(in_fname)) == None:
+        in_params = write_hash_for_fname(in_fname)
+    return op.join(settings['conv_path'],
+                   conv_key_for(in_params, settings['sox_params']) +
+                   settings['conv_ext'])
+
+
+# Locks for files that parallel builds may write, keyed by absolute path.
+_PATH_LOCKS = {}
+_PATH_LOCKS_LOCK = threading.Lock()
+
+
+def path_lock(fname):
+    """ Return lock for filename `fname`, shared across threads
+    """
+    with _PATH_LOCKS_LOCK:
+        return _PATH_LOCKS.setdefault(op.abspath(fname), threading.Lock())
+
+
 def write_converted_file(in_fname,
                          full_out_fname,
                          settings,
-                         force=False):
-    froot, ext = op.splitext(in_fname)
+                         force=False,
+                         encoder=None,
+                         store=None,
+                         params_getter=stored_params_for):
     ensure_dir(settings['conv_path'])
-    conv_fname = op.join(settings['conv_path'],
-                         op.basename(froot) + settings['conv_ext'])
-    out_params = convert_file(in_fname, conv_fname, settings['sox_params'])
-    shutil.copyfile(conv_fname, full_out_fname)
+    conv_fname = conv_fname_for(in_fname, settings, params_getter)
+    # Tracks with the same input share a cache entry.
+    with path_lock(conv_fname):
+        out_params = convert_file(in_fname, conv_fname,
+                                  settings['sox_params'], encoder, store,
+                                  params_getter)
+        # Mark as recently used, for cache eviction.
+        os.utime(params_fname_for(conv_fname))
+        shutil.copyfile(conv_fname, full_out_fname)
     return out_params
 
 
+def limit_conv_cache(settings):
+    """ Evict from conversion cache to ``conv_cache_mb`` setting, if set
+
+    Returns list of removed filenames.
+    """
+    if settings['conv_cache_mb'] is None:
+        return []
+    return evict_conv_cache(settings['conv_path'],
+                            settings['conv_ext'],
+                            settings['conv_cache_mb'] * 2 ** 20)
+
+
+def conv_cache_entries(conv_path, conv_ext):
+    """ Return list of (last use time, size, filename) for cache entries
+
+    The last use time is the modification time of the params file, or the
+    file itself, if there is no params file.
+    """
+    entries = []
+    if not op.isdir(conv_path):
+        return entries
+    for fn in os.listdir(conv_path):
+        if not fn.endswith(conv_ext):
+            continue
+        fname = op.join(conv_path, fn)
+        params_fname = params_fname_for(fname)
+        stamp_fname = params_fname if op.isfile(params_fname) else fname
+        entries.append((op.getmtime(stamp_fname),
+                        op.getsize(fname),
+                        fname))
+    return sorted(entries)
+
+
+def _rm_conv_entry(fname):
+    os.unlink(fname)
+    if op.isfile(params_fname := params_fname_for(fname)):
+        os.unlink(params_fname)
+
+
+def evict_conv_cache(conv_path, conv_ext, max_bytes):
+    """ Remove least recently used cache entries until below `max_bytes`
+
+    Returns list of removed filenames.
+    """
+    entries = conv_cache_entries(conv_path, conv_ext)
+    total = sum(size for _, size, _ in entries)
+    removed = []
+    for _, size, fname in entries:
+        if total <= max_bytes:
+            break
+        _rm_conv_entry(fname)
+        total -= size
+        removed.append(fname)
+    return removed
+
+
+def gc_conv_cache(tracks, settings):
+    """ Remove conversion cache entries not used by any track in `tracks`
+
+    Returns
+    -------
+    removed : list
+        Removed filenames.
+    missing : list
+        Track keys for which we could not find the input file.
+    """
+    used = set()
+    missing = []
+    for fbase in tracks:
+        try:
+            music_fname = find_file(fbase, settings['wav_paths'])
+        except RuntimeError:
+            missing.append(fbase)
+            continue
+        used.add(op.abspath(conv_fname_for(music_fname, settings)))
+    removed = []
+    for _, _, fname in conv_cache_entries(settings['conv_path'],
+                                          settings['conv_ext']):
+        if op.abspath(fname) not in used:
+            _rm_conv_entry(fname)
+            removed.append(fname)
+    return removed, missing
+
+
+def _send_msg(sock, header, fname=None):
+    """ Send JSON `header`, then contents of `fname` if not None
+    """
+    data = dict2json(header).encode()
+    sock.sendall(struct.pack('!Q', len(data)) + data)
+    if fname is not None:
+        with open(fname, 'rb') as fobj:
+            sock.sendfile(fobj)
+
+
+def _recv_exact(rfile, n_bytes):
+    data = rfile.read(n_bytes)
+    if len(data) != n_bytes:
+        raise ConnectionError('Connection closed mid-message')
+    return data
+
+
+def _recv_msg(rfile):
+    n_bytes, = struct.unpack('!Q', _recv_exact(rfile, 8))
+    return json.loads(_recv_exact(rfile, n_bytes))
+
+
+def _recv_file(rfile, n_bytes, fname, block_size=HASH_BLOCK):
+    """ Write `n_bytes` from `rfile` to `fname`, return md5 of data
+    """
+    md5 = hashlib.md5()
+    with open(fname, 'wb') as fobj:
+        while n_bytes:
+            block = _recv_exact(rfile, min(block_size, n_bytes))
+            md5.update(block)
+            fobj.write(block)
+            n_bytes -= len(block)
+    return md5.hexdigest()
+
+
+def _file_header(fname, **kwargs):
+    return dict(size=op.getsize(fname), md5=file_md5(fname), **kwargs)
+
+
+# Worker accepts only options, numbers and file extensions from clients.
+SAFE_PARAM = re.compile(r'^(-{1,2}[A-Za-z][\w-]*|[+-]?\d+(\.\d+)?)$')
+SAFE_EXT = re.compile(r'^\.\w+$')
+
+
+def check_worker_header(header, allowed_params=None):
+    """ Return error message for unacceptable request `header`, or None
+    """
+    params = header.get('sox_params')
+    if not isinstance(params, list):
+        return 'Missing encoder parameters'
+    if allowed_params is not None:
+        if params != [str(p) for p in allowed_params]:
+            return 'Encoder parameters not allowed'
+    elif not all(isinstance(p, str) and SAFE_PARAM.match(p)
+                 for p in params):
+        return 'Encoder parameters must be options or numbers'
+    if not all(isinstance(header.get(k), str) and SAFE_EXT.match(header[k])
+               for k in ('in_ext', 'out_ext')):
+        return 'Invalid file extension'
+    return None
+
+
+class EncodeHandler(socketserver.StreamRequestHandler):
+    """ Receive input file and encoder parameters, send back encoded file
+    """
+
+    def handle(self):
+        header = _recv_msg(self.rfile)
+        if (message := check_worker_header(
+            header, self.server.allowed_params)) is not None:
+            # Read input, so client can read our reply.
+            _recv_file(self.rfile, int(header.get('size', 0)), os.devnull)
+            _send_msg(self.connection, {'status': 'error',
+                                        'message': message})
+            return
+        with TemporaryDirectory() as tmpdir:
+            in_fname = op.join(tmpdir, 'input' + header['in_ext'])
+            out_fname = op.join(tmpdir, 'output' + header['out_ext'])
+            if _recv_file(self.rfile, header['size'],
+                          in_fname) != header['md5']:
+                _send_msg(self.connection, {'status': 'error',
+                                            'message': 'Input hash mismatch'})
+                return
+            try:
+                check_call(list(self.server.converter) + [in_fname] +
+                           header['sox_params'] + [out_fname])
+            except (CalledProcessError, OSError) as e:
+                _send_msg(self.connection, {'status': 'error',
+                                            'message': str(e)})
+                return
+            _send_msg(self.connection,
+                      _file_header(out_fname, status='ok'),
+                      out_fname)
+
+
+class EncodeServer(socketserver.ThreadingTCPServer):
+    """ Encode worker, serving `EncodeHandler` requests on `address`
+
+    Parameters
+    ----------
+    address : tuple
+        (host, port) on which to listen.  Port 0 picks a free port.
+    converter : sequence, optional
+        Command to run, before input filename, encoder parameters and output
+        filename.
+    allowed_params : None or sequence, optional
+        If not None, only accept requests with these encoder parameters.
+        Otherwise accept parameters that are options or numbers.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, converter=('sox',), allowed_params=None):
+        self.converter = converter
+        self.allowed_params = allowed_params
+        super().__init__(address, EncodeHandler)
+
+
+def parse_address(address, default_port=WORKER_PORT):
+    host, _, port = address.rpartition(':')
+    if not host:
+        return address, default_port
+    return host, int(port)
+
+
+class RemoteEncoder:
+    """ Send conversions to encode workers, trying each worker in turn
+
+    Parameters
+    ----------
+    addresses : sequence
+        Worker addresses, as "host:port" strings.
+    timeout : float, optional
+        Socket timeout in seconds.
+    """
+
+    def __init__(self, addresses, timeout=600):
+        self.addresses = [parse_address(a) for a in addresses]
+        self.timeout = timeout
+        self._counter = count()
+
+    def _convert_on(self, address, in_fname, out_fname, sox_params, in_md5):
+        header = dict(sox_params=sox_params,
+                      in_ext=op.splitext(in_fname)[1],
+                      out_ext=op.splitext(out_fname)[1],
+                      size=op.getsize(in_fname),
+                      md5=in_md5)
+        # Unique name, as other threads may be writing to the same output.
+        tmp_fname = f'{out_fname}.{threading.get_ident()}{PARTIAL_EXT}'
+        try:
+            with socket.create_connection(address, self.timeout) as sock:
+                _send_msg(sock, header, in_fname)
+                with sock.makefile('rb') as rfile:
+                    reply = _recv_msg(rfile)
+                    if reply['status'] != 'ok':
+                        raise RuntimeError(reply['message'])
+                    md5 = _recv_file(rfile, reply['size'], tmp_fname)
+            if md5 != reply['md5']:
+                raise RuntimeError(f'Hash mismatch for output from {address}')
+            os.replace(tmp_fname, out_fname)
+        finally:
+            # Failed transfers leave partial files.
+            if op.isfile(tmp_fname):
+                os.unlink(tmp_fname)
+
+    def convert(self, in_fname, out_fname, sox_params, in_md5):
+        """ Convert `in_fname` to `out_fname` on first worker to succeed
+        """
+        n = len(self.addresses)
+        start = next(self._counter)
+        errors = []
+        for i in range(n):
+            address = self.addresses[(start + i) % n]
+            try:
+                return self._convert_on(address, in_fname, out_fname,
+                                        sox_params, in_md5)
+            except (OSError, ValueError, RuntimeError) as e:
+                METRICS.incr('worker_failures')
+                errors.append(f'{address[0]}:{address[1]}: {e}')
+        raise RuntimeError(f'All workers failed for {in_fname}:\n' +
+                           '\n'.join(errors))
+
+
+class SharedStore:
+    """ Base class for shared cache of build results
+
+    Each entry has a sidecar with the hash of the entry contents, written
+    after the contents, so we can check entries when we read them.
+    Subclasses implement ``_read(name)``, returning bytes for `name` or None
+    if not present, and ``_write(name, data)``.
+
+    The cache is an optimization; if we cannot reach it, `get` counts a miss
+    and `put` does nothing, so the build carries on with local work.
+    """
+
+    hash_ext = '.md5'
+    # Errors from an unreachable or failing store.
+    errors = (OSError, requests.RequestException)
+
+    def get(self, key):
+        """ Return contents for `key`, or None if missing, corrupt or error
+        """
+        try:
+            data = self._get_checked(key)
+        except self.errors:
+            METRICS.incr('shared_cache_errors')
+            data = None
+        METRICS.hit('shared_cache', data is not None)
+        return data
+
+    def _get_checked(self, key):
+        if (md5 := self._read(key + self.hash_ext)) is None:
+            return None
+        if (data := self._read(key)) is None:
+            return None
+        if hashlib.md5(data).hexdigest() != md5.decode().strip():
+            METRICS.incr('shared_cache_corrupt')
+            return None
+        return data
+
+    def put(self, key, data):
+        try:
+            self._write(key, data)
+            self._write(key + self.hash_ext,
+                        hashlib.md5(data).hexdigest().encode())
+        except self.errors:
+            METRICS.incr('shared_cache_errors')
+
+    def get_file(self, key, fname):
+        """ Write contents for `key` to `fname`; return False if no entry
+        """
+        if (data := self.get(key)) is None:
+            return False
+        with open(fname, 'wb') as fobj:
+            fobj.write(data)
+        return True
+
+    def put_file(self, key, fname):
+        with open(fname, 'rb') as fobj:
+            self.put(key, fobj.read())
+
+
+class DirStore(SharedStore):
+    """ Shared cache in directory, e.g. on a network filesystem
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _read(self, name):
+        fname = op.join(self.path, name)
+        if not op.isfile(fname):
+            return None
+        with open(fname, 'rb') as fobj:
+            return fobj.read()
+
+    def _write(self, name, data):
+        ensure_dir(self.path)
+        fname = op.join(self.path, name)
+        # Unique temporary name; other machines may write the same entry.
+        tmp_fname = f'{fname}.{os.getpid()}.{threading.get_ident()}'
+        with open(tmp_fname, 'wb') as fobj:
+            fobj.write(data)
+        os.replace(tmp_fname, fname)
+
+
+class HTTPStore(SharedStore):
+    """ Shared cache on HTTP server accepting GET and PUT
+    """
+
+    def __init__(self, url, timeout=60):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _read(self, name):
+        METRICS.incr('http_requests')
+        response = requests.get(f'{self.url}/{name}', timeout=self.timeout)
+        return response.content if response.status_code == 200 else None
+
+    def _write(self, name, data):
+        METRICS.incr('http_requests')
+        requests.put(f'{self.url}/{name}', data=data,
+                     timeout=self.timeout).raise_for_status()
+
+
+def get_store(location):
+    """ Shared store for `location`, a URL or directory, or None
+    """
+    if location is None:
+        return None
+    if location.startswith(('http://', 'https://')):
+        return HTTPStore(location)
+    return DirStore(location)
+
+
+class StoreHTTPHandler(SimpleHTTPRequestHandler):
+    """ Serve files from directory, and write files from PUT requests
+
+    A minimal server for `HTTPStore`.
+    """
+
+    def do_PUT(self):
+        fname = self.translate_path(self.path)
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        DirStore(op.dirname(fname))._write(op.basename(fname), data)
+        self.send_response(201)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def store_server(path, address):
+    """ HTTP server for `HTTPStore`, storing entries in `path`
+    """
+    return ThreadingHTTPServer(
+        address, partial(StoreHTTPHandler, directory=path))
+
+
 def same_params_for(exp_params, out_fname):
     if exp_params is None:
         return False
     # JSON roundtrip for input parameters
     d2j2d = json.loads(dict2json(exp_params))
     if (out_params:= stored_params_for(out_fname)) is None:
+        return METRICS.hit('same_params', False)
+    # Output hash is a result, not a parameter.
+    out_params.pop(OUT_HASH_KEY, None)
+    return METRICS.hit('same_params', out_params == d2j2d)
+
+
+class BuildSession:
+    """ Caches for file lookup, stored params, images and HTTP responses
+
+    Cached values are checked against file modification times before use, so
+    a session can live as long as the process.  Processed images and HTTP
+    responses are the large values; we keep at most `max_cached` of each,
+    dropping the oldest first, and `clear` drops them all.
+    """
+
+    max_cached = 256
+
+    def __init__(self):
+        self._files = {}
+        self._params = {}
+        self._images = {}
+        self._http = {}
+        self._encoders = {}
+        self._stores = {}
+        self._catalogs = {}
+        self._cache_lock = threading.Lock()
+
+    def clear(self):
+        """ Drop cached images and HTTP responses
+        """
+        with self._cache_lock:
+            self._images.clear()
+            self._http.clear()
+
+    def _cache_put(self, cache, key, value):
+        with self._cache_lock:
+            while len(cache) >= self.max_cached:
+                # Dicts keep insertion order; first key is oldest.
+                del cache[next(iter(cache))]
+            cache[key] = value
+        return value
+
+    def find_file(self, fbase, paths):
+        key = (fbase, tuple(paths))
+        if (fname := self._files.get(key)) is None or not op.isfile(fname):
+            fname = self._files[key] = find_file(fbase, paths)
+        return fname
+
+    def _stamp(self, fname):
+        params_fname = params_fname_for(fname)
+        if not op.isfile(params_fname):
+            return None
+        return (os.stat(fname).st_mtime_ns, os.stat(params_fname).st_mtime_ns)
+
+    def stored_params_for(self, fname):
+        if (stamp := self._stamp(fname)) is None:
+            return stored_params_for(fname)
+        if (cached := self._params.get(fname)) and cached[0] == stamp:
+            METRICS.hit('stored_params', True)
+            return cached[1]
+        params = stored_params_for(fname)
+        self._params[fname] = (stamp, params)
+        return params
+
+    def proc_image(self, img_fname, min_img_size, out_dim, store=None,
+                   write_hash=True):
+        # Tracks built in parallel often share images; process each once,
+        # while other images proceed in parallel.
+        with path_lock(img_fname):
+            if (img_params := self.stored_params_for(img_fname)) is None:
+                img_params = (write_hash_for_fname(img_fname) if write_hash
+                              else hash_params_for(img_fname))
+            key = (img_fname, dict2json(img_params), tuple(min_img_size),
+                   out_dim)
+            if (cached := self._images.get(key)) is None:
+                cached = self._cache_put(self._images, key, write_proc_image(
+                    img_fname, min_img_size, out_dim, store,
+                    self.stored_params_for, write_hash))
+        return cached
+
+    def get_encoder(self, settings):
+        """ Remote encoder for ``encode_workers`` setting, or None
+        """
+        if not (addresses := settings.get('encode_workers')):
+            return None
+        key = tuple(addresses)
+        if (encoder := self._encoders.get(key)) is None:
+            encoder = self._encoders[key] = RemoteEncoder(addresses)
+        return encoder
+
+    def get_store(self, settings):
+        """ Shared store for ``shared_cache`` setting, or None
+        """
+        location = settings.get('shared_cache')
+        if location not in self._stores:
+            self._stores[location] = get_store(location)
+        return self._stores[location]
+
+    def get_catalog(self, settings):
+        """ Catalog for ``catalog_fname`` setting, or None
+        """
+        if (fname := settings.get('catalog_fname')) is None:
+            return None
+        if (catalog := self._catalogs.get(fname)) is None:
+            catalog = self._catalogs[fname] = Catalog(fname)
+        return catalog
+
+    def http_get(self, url, **kwargs):
+        # Errors raise before caching, so we only cache successes.
+        if (content := self._http.get(url)) is None:
+            content = self._cache_put(self._http, url,
+                                      http_get(url, **kwargs))
+        return content
+
+
+def track_out_for(fbase, config, settings):
+    """ Return tag entry, image basename and output filename for track
+    """
+    entry = config.copy()
+    # Remove folder and image entries.
+    folder_name = entry.pop('folder_name')
+    in_img_fname = entry.pop('img_fname')
+    if folder_name is None:
+        folder_name = guess_folder(fbase)
+    full_out_dir = op.join(settings['out_path'], folder_name)
+    out_fbase = out_fbaseroot_for(folder_name, entry)
+    full_out_fname = op.join(full_out_dir,
+                             out_fbase + settings['conv_ext'])
+    return entry, in_img_fname, full_out_fname
+
+
+def art_params_for(settings):
+    """ Parameters for album art in tracks, or None for full embedded art
+    """
+    if (mode := settings['album_art']) == 'embed':
+        return None
+    if mode == 'thumb':
+        return {'mode': mode, 'thumb_dim': settings['thumb_dim']}
+    return {'mode': mode}
+
+
+def exp_params_for(music_fname, img_fname, entry, session=None,
+                   art_params=None):
+    session = BuildSession() if session is None else session
+    params = dict(
+        music_params=session.stored_params_for(music_fname),
+        img_params=session.stored_params_for(img_fname),
+        entry=entry)
+    # Only add art params when not default, so default params do not change.
+    if art_params is not None:
+        params['album_art'] = art_params
+    return params
+
+
+def track_art_for(img_fname, settings, session=None, write=True):
+    """ Return image params, image data to embed in track (or None)
+
+    If `write` is False, do not write hash files or to the shared cache.
+    """
+    session = BuildSession() if session is None else session
+    mode = settings['album_art']
+    img_params, img_data = session.proc_image(
+        img_fname,
+        settings['min_img_size'],
+        settings['thumb_dim'] if mode == 'thumb' else settings['out_dim'],
+        session.get_store(settings) if write else None,
+        write_hash=write)
+    return img_params, None if mode == 'none' else img_data
+
+
+def write_cover(img_fname, out_dir, settings, session=None):
+    """ Write album art file to `out_dir`, if not already up to date
+
+    Returns True if we wrote the file.
+    """
+    session = BuildSession() if session is None else session
+    cover_fname = op.join(out_dir, OUT_COVER_BASENAME)
+    exp_params = dict(img_params=session.stored_params_for(img_fname),
+                      out_dim=settings['out_dim'])
+    if op.isfile(cover_fname) and same_params_for(exp_params, cover_fname):
         return False
-    return out_params == d2j2d
+    exp_params['img_params'], img_data = session.proc_image(
+        img_fname,
+        settings['min_img_size'],
+        settings['out_dim'],
+        session.get_store(settings))
+    # Tracks from the same album may be building in parallel.
+    tmp_fname = f'{cover_fname}.{threading.get_ident()}{PARTIAL_EXT}'
+    with open(tmp_fname, 'wb') as fobj:
+        fobj.write(img_data)
+    os.replace(tmp_fname, cover_fname)
+    write_params_for(exp_params, cover_fname)
+    return True
 
 
 def write_song(music_fname,
@@ -202,26 +1100,28 @@ def write_song(music_fname,
                full_out_fname,
                entry,
                settings,
-               force=False):
-    exp_params = dict(
-        music_params=stored_params_for(music_fname),
-        img_params=stored_params_for(img_fname),
-        entry=entry)
+               force=False,
+               session=None):
+    session = BuildSession() if session is None else session
+    exp_params = exp_params_for(music_fname, img_fname, entry, session,
+                                art_params_for(settings))
     if same_params_for(exp_params, full_out_fname):
-        return
+        return False
     if op.exists(full_out_fname) and not force:
         raise RuntimeError(f'File {full_out_fname} exists')
     write_converted_file(music_fname, full_out_fname, settings,
-                         force=force)
-    exp_params['music_params'] = stored_params_for(music_fname)
+                         force=force,
+                         encoder=session.get_encoder(settings),
+                         store=session.get_store(settings),
+                         params_getter=session.stored_params_for)
+    exp_params['music_params'] = session.stored_params_for(music_fname)
     # Add tags and image
-    exp_params['img_params'], img_data = write_proc_image(
-        img_fname,
-        settings['min_img_size'],
-        settings['out_dim'],
-    )
+    exp_params['img_params'], img_data = track_art_for(
+        img_fname, settings, session)
     write_tags(full_out_fname, entry, img_data)
+    exp_params[OUT_HASH_KEY] = file_md5(full_out_fname)
     write_params_for(exp_params, full_out_fname)
+    return True
 
 
 def get_tag_maker():
@@ -262,9 +1162,10 @@ def get_tag_maker():
     return EasyID3
 
 
-def write_tags(full_out_fname, entry, img_data):
+def tags_for(entry, img_data):
     etags = get_tag_maker()()
-    etags['cover_front'] = img_data
+    if img_data is not None:
+        etags['cover_front'] = img_data
     for key, value in entry.items():
         if not key in etags.valid_keys:
             continue
@@ -274,19 +1175,64 @@ def write_tags(full_out_fname, entry, img_data):
     # Give more space to the title, which can be long.
     if not 'details' in entry:
         etags['details'] = entry['title']
-    etags.save(full_out_fname)
+    return etags
+
+
+def write_tags(full_out_fname, entry, img_data):
+    tags_for(entry, img_data).save(full_out_fname)
+
+
+def _frame_value(frame):
+    if hasattr(frame, 'data'):  # Picture frames.
+        return 'md5:' + hashlib.md5(frame.data).hexdigest()
+    return str(frame)
+
+
+def id3_values(filething):
+    """ Dictionary of ID3 frame values from filename or file object
+
+    Only reads the ID3 header.  Picture frames have the hash of the picture
+    data as value.
+    """
+    from mutagen.id3 import ID3, ID3NoHeaderError
+    try:
+        id3 = ID3(filething)
+    except ID3NoHeaderError:
+        return {}
+    return {key: _frame_value(frame) for key, frame in id3.items()}
+
+
+def exp_id3_values(entry, img_data):
+    """ Dictionary of ID3 frame values that `write_tags` would write
+    """
+    fobj = BytesIO()
+    tags_for(entry, img_data).save(fobj)
+    fobj.seek(0)
+    return id3_values(fobj)
 
 
 def write_proc_image(img_fname, min_img_size=(640, 480),
-                     out_dim=1024):
-    if (img_params := stored_params_for(img_fname)) == None:
-        img_params = write_hash_for_fname(img_fname)
+                     out_dim=1024, store=None,
+                     params_getter=stored_params_for,
+                     write_hash=True):
+    if (img_params := params_getter(img_fname)) == None:
+        img_params = (write_hash_for_fname(img_fname) if write_hash
+                      else hash_params_for(img_fname))
+    # Only reads image header.
     img = Image.open(img_fname)
     if img.size < tuple(min_img_size):
         raise ValueError(f'Low resolution image {img_fname}')
-    img = resize_img(img, out_dim)
-    fobj = BytesIO()
-    img.save(fobj, format="jpeg")
+    store_key = hashlib.md5(dict2json(dict(
+        img_params=img_params, out_dim=out_dim)).encode()).hexdigest() + '.jpg'
+    if store is not None and (data := store.get(store_key)) is not None:
+        return img_params, data
+    METRICS.incr('images_processed')
+    with METRICS.timer('image'):
+        img = resize_img(img, out_dim)
+        fobj = BytesIO()
+        img.save(fobj, format="jpeg")
+    if store is not None:
+        store.put(store_key, fobj.getvalue())
     return img_params, fobj.getvalue()
 
 
@@ -298,35 +1244,864 @@ def guess_folder(fbase):
 
 def ensure_dir(path):
     if not op.isdir(path):
-        os.makedirs(path)
+        os.makedirs(path, exist_ok=True)
 
 
-def build_one(fbase, config, settings, force=False):
-    music_fname = find_file(fbase, settings['wav_paths'])
-    entry = config.copy()
-    # Remove folder and image entries.
-    folder_name = entry.pop('folder_name')
-    in_img_fname = entry.pop('img_fname')
-    img_fname = find_file(in_img_fname,
-                          settings['img_paths'])
-    if folder_name is None:
-        folder_name = guess_folder(fbase)
-    full_out_dir = op.join(settings['out_path'], folder_name)
-    ensure_dir(full_out_dir)
-    out_fbase = out_fbaseroot_for(folder_name, entry)
-    full_out_fname = op.join(full_out_dir,
-                             out_fbase + settings['conv_ext'])
-    write_song(music_fname,
-               img_fname,
-               full_out_fname, entry,
-               settings, force=force)
+def cover_images(tracks, settings):
+    """ Image for album art file in each output folder of `tracks`
+
+    Tracks in one folder can have different images, e.g. per disc; use the
+    image of the first track in the folder.
+    """
+    covers = {}
+    for fbase, config in tracks.items():
+        entry, in_img_fname, full_out_fname = track_out_for(
+            fbase, config, settings)
+        covers.setdefault(op.dirname(full_out_fname), in_img_fname)
+    return covers
+
+
+def remove_cover(out_dir):
+    """ Remove album art file that we wrote to `out_dir`, if present
+    """
+    cover_fname = op.join(out_dir, OUT_COVER_BASENAME)
+    # Only remove covers with params files; we wrote these.
+    if op.isfile(params_fname := params_fname_for(cover_fname)):
+        if op.isfile(cover_fname):
+            os.unlink(cover_fname)
+        os.unlink(params_fname)
+
+
+def build_one(fbase, config, settings, force=False, session=None,
+              cover_img=None):
+    session = BuildSession() if session is None else session
+    music_fname = session.find_file(fbase, settings['wav_paths'])
+    entry, in_img_fname, full_out_fname = track_out_for(
+        fbase, config, settings)
+    img_fname = session.find_file(in_img_fname,
+                                  settings['img_paths'])
+    out_dir = op.dirname(full_out_fname)
+    ensure_dir(out_dir)
+    if settings['album_art'] == 'embed':
+        remove_cover(out_dir)
+    else:
+        cover_fname = (img_fname if cover_img is None else
+                       session.find_file(cover_img, settings['img_paths']))
+        write_cover(cover_fname, out_dir, settings, session)
+    start = time.perf_counter()
+    built = write_song(music_fname,
+                       img_fname,
+                       full_out_fname, entry,
+                       settings, force=force,
+                       session=session)
+    if (catalog := session.get_catalog(settings)) is not None:
+        catalog.update(fbase, entry, full_out_fname)
+    METRICS.incr('tracks_built' if built else 'tracks_skipped')
+    METRICS.event('track', track=fbase, out_fname=full_out_fname,
+                  built=built, seconds=time.perf_counter() - start)
+    return built
+
+
+def build_tracks(tracks, settings, force=False, session=None, n_jobs=None,
+                 verbose=False, all_tracks=None):
+    """ Build `tracks`, in parallel if `n_jobs` > 1
+
+    Parameters
+    ----------
+    tracks : dict
+        Track configurations, keyed by input filename.
+    settings : dict
+        Settings.
+    force : bool, optional
+        Whether to overwrite existing output files.
+    session : None or BuildSession, optional
+        Session with caches.
+    n_jobs : None or int, optional
+        Number of tracks to build at the same time.  None means use the
+        ``build_jobs`` setting if present, otherwise one job per encode
+        worker, or one job if there are no encode workers.
+    verbose : bool, optional
+        If True, print name of each track as we build it.
+    all_tracks : None or dict, optional
+        All track configurations, from which we choose the album art file
+        for each output folder.  None means use `tracks`.
+
+    Returns
+    -------
+    built : list
+        Tracks for which we wrote new outputs.
+    """
+    session = BuildSession() if session is None else session
+    METRICS.start()
+    covers = cover_images(tracks if all_tracks is None else all_tracks,
+                          settings)
+    if n_jobs is None:
+        n_jobs = settings.get('build_jobs') or max(
+            len(settings.get('encode_workers') or []), 1)
+
+    def build(item):
+        fbase, config = item
+        if verbose:
+            print('Building', fbase)
+        out_dir = op.dirname(track_out_for(fbase, config, settings)[2])
+        return build_one(fbase, config, settings, force, session=session,
+                         cover_img=covers.get(out_dir))
+
+    with ThreadPoolExecutor(n_jobs) as pool:
+        built = [fbase for fbase, was_built in
+                 zip(tracks, pool.map(build, tracks.items())) if was_built]
+    # Evict once all builds have finished with their cache entries.
+    limit_conv_cache(settings)
+    return built
+
+
+def verify_one(fbase, config, settings, check_hash=False, session=None):
+    """ Return list of differences between output for track and config
+
+    Parameters
+    ----------
+    fbase : str
+        Track (input filename) key.
+    config : dict
+        Track configuration.
+    settings : dict
+        Settings.
+    check_hash : bool, optional
+        If True, check output file hash against hash stored at build time.
+    session : None or BuildSession, optional
+        Session with caches.
+
+    Returns
+    -------
+    problems : list
+        List of strings describing drift of the output from the
+        configuration.  Empty if output is up to date.
+    """
+    session = BuildSession() if session is None else session
+    entry, in_img_fname, full_out_fname = track_out_for(
+        fbase, config, settings)
+    if not op.isfile(full_out_fname):
+        return [f'missing {full_out_fname}']
+    # Missing inputs are problems for this track, not errors for the run.
+    in_fnames = []
+    for name, paths in ((fbase, settings['wav_paths']),
+                        (in_img_fname, settings['img_paths'])):
+        try:
+            in_fnames.append(session.find_file(name, paths))
+        except RuntimeError:
+            in_fnames.append(None)
+    if None in in_fnames:
+        return [f'missing input {name}' for name, fname
+                in zip((fbase, in_img_fname), in_fnames) if fname is None]
+    music_fname, img_fname = in_fnames
+    problems = []
+    if not same_params_for(
+        exp_params_for(music_fname, img_fname, entry, session,
+                       art_params_for(settings)),
+        full_out_fname):
+        problems.append('stored params differ from inputs / config')
+    if settings['album_art'] != 'embed' and not op.isfile(
+        op.join(op.dirname(full_out_fname), OUT_COVER_BASENAME)):
+        problems.append(f'missing {OUT_COVER_BASENAME}')
+    # Verify only reads; do not store hashes or processed images.
+    img_params, img_data = track_art_for(img_fname, settings, session,
+                                         write=False)
+    exp_values = exp_id3_values(entry, img_data)
+    values = id3_values(full_out_fname)
+    for key in sorted(set(exp_values).union(values)):
+        if (exp := exp_values.get(key)) != (value := values.get(key)):
+            problems.append(f'{key}: expected {exp!r}, found {value!r}')
+    if check_hash:
+        out_params = stored_params_for(full_out_fname) or {}
+        if (out_md5 := out_params.get(OUT_HASH_KEY)) is None:
+            problems.append('no stored output hash')
+        elif out_md5 != file_md5(full_out_fname):
+            problems.append('output hash differs from stored hash')
+    return problems
+
+
+def verify_tracks(tracks, settings, check_hash=False, n_workers=4,
+                  session=None):
+    """ Verify outputs for `tracks` in parallel
+
+    Returns dictionary with track keys, list of problems as values, for
+    tracks with problems.
+    """
+    session = BuildSession() if session is None else session
+
+    def verify(item):
+        fbase, config = item
+        return fbase, verify_one(fbase, config, settings, check_hash,
+                                 session)
+
+    with ThreadPoolExecutor(n_workers) as pool:
+        return {fbase: problems for fbase, problems
+                in pool.map(verify, tracks.items()) if problems}
+
+
+def _out_duration(fname):
+    import mutagen
+    try:
+        audio = mutagen.File(fname)
+    except mutagen.MutagenError:
+        return None
+    return None if audio is None else audio.info.length
+
+
+class Catalog:
+    """ SQLite index of output files and their tags
+
+    Parameters
+    ----------
+    fname : str
+        Filename of SQLite database.
+    create : bool, optional
+        If True, create database if it does not exist, otherwise raise an
+        error.
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS tracks (
+        track TEXT PRIMARY KEY,
+        out_fname TEXT NOT NULL,
+        title TEXT,
+        artist TEXT,
+        duration REAL,
+        size INTEGER,
+        mtime REAL,
+        entry TEXT);
+    CREATE TABLE IF NOT EXISTS tags (
+        track TEXT NOT NULL,
+        key TEXT NOT NULL,
+        value TEXT NOT NULL COLLATE NOCASE);
+    CREATE INDEX IF NOT EXISTS tags_key_value ON tags (key, value);
+    CREATE INDEX IF NOT EXISTS tags_track ON tags (track);
+    """
+
+    def __init__(self, fname, create=True):
+        if not create and not op.isfile(fname):
+            raise RuntimeError(f'No catalog {fname}; run "build" first')
+        self.fname = fname
+        if (dirname := op.dirname(fname)):
+            ensure_dir(dirname)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(fname, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.executescript(self.schema)
+
+    def close(self):
+        self._conn.close()
+
+    def update(self, track, entry, out_fname):
+        """ Add or update catalog row for `track`, if changed
+
+        Returns True if we updated the catalog.
+        """
+        # Absolute paths, so playlists work from any directory.
+        out_fname = op.abspath(out_fname)
+        st = os.stat(out_fname)
+        entry_json = dict2json(entry)
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                'SELECT out_fname, size, mtime, entry FROM tracks '
+                'WHERE track = ?', (track,)).fetchone()
+            if row is not None and tuple(row) == (
+                out_fname, st.st_size, st.st_mtime, entry_json):
+                return False
+            self._conn.execute('DELETE FROM tags WHERE track = ?', (track,))
+            self._conn.execute(
+                'INSERT OR REPLACE INTO tracks '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (track, out_fname, entry.get('title'),
+                 entry.get('artist'), _out_duration(out_fname),
+                 st.st_size, st.st_mtime, entry_json))
+            self._conn.executemany(
+                'INSERT INTO tags VALUES (?, ?, ?)',
+                [(track, key, str(value))
+                 for key in CATALOG_KEYS
+                 for value in _as_list(entry.get(key))])
+        return True
+
+    def prune(self, tracks):
+        """ Remove catalog rows for tracks not in `tracks`
+        """
+        with self._lock, self._conn:
+            known = [r[0] for r in self._conn.execute(
+                'SELECT track FROM tracks ORDER BY track')]
+            gone = [(t,) for t in known if t not in tracks]
+            self._conn.executemany('DELETE FROM tracks WHERE track = ?', gone)
+            self._conn.executemany('DELETE FROM tags WHERE track = ?', gone)
+        return [t for t, in gone]
+
+    def query(self, **criteria):
+        """ Return rows for tracks matching all `criteria`
+
+        Criteria are field=value pairs, where field is one of `CATALOG_KEYS`.
+        Matching is case insensitive; "*" in the value matches any
+        characters.
+        """
+        sql = 'SELECT * FROM tracks'
+        conditions = []
+        args = []
+        for key, value in criteria.items():
+            if key not in CATALOG_KEYS:
+                raise ValueError(f'Cannot query on {key}; expecting one of ' +
+                                 ', '.join(CATALOG_KEYS))
+            op_str = 'LIKE' if '*' in value else '='
+            conditions.append(
+                'track IN (SELECT track FROM tags '
+                f'WHERE key = ? AND value {op_str} ?)')
+            args += [key, value.replace('*', '%')]
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY out_fname'
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(sql, args)]
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def parse_query(query_str):
+    """ Parse "key=value;key2=value2" query string to dict
+    """
+    criteria = {}
+    for part in query_str.split(';'):
+        if not part.strip():
+            continue
+        key, sep, value = part.partition('=')
+        if not sep:
+            raise ValueError(f'Expecting key=value in "{part}"')
+        criteria[key.strip()] = value.strip()
+    return criteria
+
+
+def write_m3u(rows, fobj, base_path=None):
+    """ Write M3U playlist for catalog `rows` to file object `fobj`
+
+    Paths in playlist are relative to `base_path`, if not None.
+    """
+    fobj.write('#EXTM3U\n')
+    for row in rows:
+        duration = -1 if row['duration'] is None else round(row['duration'])
+        title = ' - '.join(v for v in (row['artist'], row['title']) if v)
+        path = (row['out_fname'] if base_path is None
+                else op.relpath(row['out_fname'], base_path))
+        fobj.write(f'#EXTINF:{duration},{title}\n{path}\n')
+
+
+def file_md5(fname, block_size=HASH_BLOCK):
+    md5 = hashlib.md5()
+    with open(fname, 'rb') as fobj:
+        while (block := fobj.read(block_size)):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def partial_md5(fname, block_size=2 ** 16):
+    """ Hash of first and last `block_size` bytes of `fname`
+    """
+    md5 = hashlib.md5()
+    with open(fname, 'rb') as fobj:
+        md5.update(fobj.read(block_size))
+        fobj.seek(max(op.getsize(fname) - block_size, block_size))
+        md5.update(fobj.read(block_size))
+    return md5.hexdigest()
+
+
+def _group_by(fnames, key_func):
+    groups = {}
+    for fname in fnames:
+        groups.setdefault(key_func(fname), []).append(fname)
+    return [g for g in groups.values() if len(g) > 1]
+
+
+def _full_md5(fname):
+    if (params := stored_params_for(fname)) is None:
+        params = write_hash_for_fname(fname)
+    return params['md5']
+
+
+def find_dupes(paths, exts=AUDIO_EXTS):
+    """ Find audio files with identical contents in directory trees `paths`
+
+    Group files by size, then by hash of the first and last blocks, and only
+    then by full hash, using (or storing) the hashes used for the build.
+    Empty files are not duplicates of each other.
+
+    Parameters
+    ----------
+    paths : sequence
+        Directories to search.
+    exts : sequence, optional
+        Only check files with these (lower case) extensions.
+
+    Returns
+    -------
+    groups : list
+        List of lists of filenames, where files in each list have the same
+        contents.
+    """
+    fnames = set()
+    for path in paths:
+        for dirpath, dirnames, filenames in os.walk(path):
+            fnames.update(op.realpath(op.join(dirpath, fn))
+                          for fn in filenames
+                          if op.splitext(fn)[1].lower() in exts)
+    groups = []
+    fnames = sorted(fn for fn in fnames if op.getsize(fn))
+    for size_group in _group_by(fnames, op.getsize):
+        for part_group in _group_by(size_group, partial_md5):
+            groups += _group_by(part_group, _full_md5)
+    return groups
+
+
+def dupes_report(tracks, settings):
+    """ Duplicate inputs in ``settings['wav_paths']``, with tracks using each
+
+    Returns list of groups, one per set of duplicate files, where each group
+    is a list of (filename, list of track keys using filename).
+    """
+    users = {}
+    for fbase in tracks:
+        try:
+            fname = find_file(fbase, settings['wav_paths'])
+        except RuntimeError:
+            continue
+        users.setdefault(op.realpath(fname), []).append(fbase)
+    return [[(fname, users.get(fname, [])) for fname in group]
+            for group in find_dupes(settings['wav_paths'])]
+
+
+def read_manifest(root):
+    """ Read manifest stored in directory `root`, or empty dict if none
+    """
+    manifest_fname = op.join(root, MANIFEST_BASENAME)
+    if not op.isfile(manifest_fname):
+        return {}
+    with open(manifest_fname, 'rt') as fobj:
+        return json.load(fobj)
+
+
+def write_manifest(manifest, root):
+    manifest_fname = op.join(root, MANIFEST_BASENAME)
+    tmp_fname = manifest_fname + PARTIAL_EXT
+    with open(tmp_fname, 'wt') as fobj:
+        json.dump(manifest, fobj, indent=0, sort_keys=True)
+    os.replace(tmp_fname, manifest_fname)
+
+
+def _same_stat(info, st, mtime_tol=0):
+    return (info['size'] == st.st_size and
+            abs(info['mtime'] - st.st_mtime) <= mtime_tol)
+
+
+def build_manifest(root, *caches, mtime_tol=0, n_workers=4, include=None):
+    """ Manifest of (size, mtime, md5) for each file in tree `root`
+
+    Parameters
+    ----------
+    root : str
+        Directory to scan.
+    *caches : dicts
+        Manifests from which to take hashes.  We use the hash from the first
+        cache entry for the same relative path with matching size and
+        modification time, and only read the file when there is no such
+        entry.
+    mtime_tol : float, optional
+        Tolerance in seconds for matching modification times.
+    n_workers : int, optional
+        Number of threads to use for hashing.
+    include : None or set, optional
+        If not None, only include files with relative paths in `include`.
+
+    Returns
+    -------
+    manifest : dict
+        Dictionary with keys being relative paths (with "/" separators), and
+        values being dicts with keys "size", "mtime", "md5".
+    """
+    manifest = {}
+    to_hash = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for fn in sorted(filenames):
+            # Build params sidecars are not for the device.
+            if (fn == MANIFEST_BASENAME or fn.endswith(PARTIAL_EXT) or
+                fn.endswith(PARAMS_EXT)):
+                continue
+            fname = op.join(dirpath, fn)
+            rel = op.relpath(fname, root).replace(os.sep, '/')
+            if include is not None and rel not in include:
+                continue
+            st = os.stat(fname)
+            info = {'size': st.st_size, 'mtime': st.st_mtime}
+            for cache in caches:
+                if (c := cache.get(rel)) and _same_stat(c, st, mtime_tol):
+                    info['md5'] = c['md5']
+                    break
+            else:
+                to_hash.append((rel, fname))
+            manifest[rel] = info
+    with ThreadPoolExecutor(n_workers) as pool:
+        hashes = pool.map(file_md5, [fname for rel, fname in to_hash])
+        for (rel, fname), md5 in zip(to_hash, hashes):
+            manifest[rel]['md5'] = md5
+    return manifest
+
+
+def _copy_in(src_fname, dst_fname):
+    ensure_dir(op.dirname(dst_fname))
+    # Copy to temporary name, then rename, so an interrupted copy never
+    # leaves a truncated file under the real name.
+    tmp_fname = dst_fname + PARTIAL_EXT
+    shutil.copy2(src_fname, tmp_fname)
+    os.replace(tmp_fname, dst_fname)
+
+
+def _remove_partials(root, rels):
+    for rel in rels:
+        partial = op.join(root, rel + PARTIAL_EXT)
+        if op.isfile(partial):
+            os.unlink(partial)
+
+
+def _remove_empty_parents(root, rels):
+    # Remove directories left empty by deleting files at `rels`.
+    root = op.abspath(root)
+    for rel in rels:
+        dirpath = op.dirname(op.join(root, rel))
+        while dirpath != root and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+            dirpath = op.dirname(dirpath)
+
+
+def sync_tree(src_path, dst_path, n_workers=4, delete=True):
+    """ Copy new and changed files from `src_path` to `dst_path`
+
+    Both directories keep a manifest of file sizes, modification times and
+    hashes, so a repeat sync only needs to stat the files, and hash those
+    that have changed.  An interrupted sync can be restarted; files that were
+    fully copied will have the same size and modification time as the source,
+    and will not be copied again.
+
+    The destination manifest records the files this function copied.  We
+    only ever delete files in that manifest, so other files in `dst_path`,
+    such as music from elsewhere, are left alone.
+
+    Parameters
+    ----------
+    src_path : str
+        Source directory.
+    dst_path : str
+        Destination directory, e.g. mounted device directory.
+    n_workers : int, optional
+        Number of threads for hashing and copying.
+    delete : bool, optional
+        If True, delete files that we copied to `dst_path` in previous syncs,
+        and that are no longer present in `src_path`.
+
+    Returns
+    -------
+    copied : list
+        Relative paths of copied files.
+    deleted : list
+        Relative paths of deleted files.
+    """
+    ensure_dir(dst_path)
+    src_manifest = build_manifest(src_path, read_manifest(src_path),
+                                  n_workers=n_workers)
+    write_manifest(src_manifest, src_path)
+    owned = read_manifest(dst_path)
+    _remove_partials(dst_path, src_manifest)
+    dst_manifest = build_manifest(dst_path, owned, src_manifest,
+                                  mtime_tol=MTIME_TOL,
+                                  n_workers=n_workers,
+                                  include=set(owned).union(src_manifest))
+    copied = sorted(rel for rel, info in src_manifest.items()
+                    if (rel not in dst_manifest or
+                        dst_manifest[rel]['md5'] != info['md5']))
+    deleted = sorted(set(dst_manifest).intersection(owned).difference(
+        src_manifest) if delete else [])
+    for rel in deleted:
+        os.unlink(op.join(dst_path, rel))
+        del dst_manifest[rel]
+    _remove_empty_parents(dst_path, deleted)
+    # Record files we are about to copy, so a later sync can delete them
+    # even if this one is interrupted.
+    write_manifest({**dst_manifest,
+                    **{rel: src_manifest[rel] for rel in copied}},
+                   dst_path)
+    with ThreadPoolExecutor(n_workers) as pool:
+        list(pool.map(lambda rel : _copy_in(op.join(src_path, rel),
+                                            op.join(dst_path, rel)),
+                      copied))
+    for rel in copied:
+        dst_manifest[rel] = src_manifest[rel]
+    write_manifest(dst_manifest, dst_path)
+    return copied, deleted
+
+
+# Map from tag names in audio files to config keys.
+IMPORT_TAG_MAP = {
+    'album': 'album',
+    'albumartist': 'albumartist',
+    'albumartistsort': 'albumartistsort',
+    'artist': 'artist',
+    'artistsort': 'artistsort',
+    'composer': 'composer',
+    'conductor': 'conductor',
+    'performer': 'performer',
+    'title': 'title',
+    'genre': 'period',
+    'period': 'period',
+    'grouping': 'style',
+    'style': 'style',
+}
+
+
+# Config keys that can have more than one value.
+MULTI_KEYS = ('composer', 'performer')
+
+
+def _split_number(val):
+    # Numbers such as "3" or "3/10"; return number and total.
+    parts = [int(p) if p.strip().isdigit() else None
+             for p in val.split('/')]
+    return parts[0], (parts[1] if len(parts) > 1 else None)
+
+
+def tags2config(tags):
+    """ Config entry from dictionary of tags, with list of strings values
+    """
+    entry = {}
+    for tag_key, key in IMPORT_TAG_MAP.items():
+        if key in entry or not (values := tags.get(tag_key)):
+            continue
+        values = [str(v) for v in values]
+        entry[key] = (values if key in MULTI_KEYS and len(values) > 1
+                      else values[0])
+    for key in ('disc', 'track'):
+        if not (values := tags.get(f'{key}number')):
+            continue
+        number, total = _split_number(str(values[0]))
+        if (total_values := tags.get(f'{key}total') or
+            tags.get(f'total{key}s')):
+            total = _split_number(str(total_values[0]))[0]
+        if number is not None:
+            entry[f'{key}number'] = number
+        if total is not None:
+            entry[f'{key}total'] = total
+    if (dates := tags.get('originaldate') or tags.get('date')):
+        year = str(dates[0])[:4]
+        if year.isdigit():
+            entry['originalyear'] = int(year)
+    return entry
+
+
+def _is_flac(fname):
+    return op.splitext(fname)[1].lower() == '.flac'
+
+
+def read_import_tags(fname):
+    """ Read tags from audio file `fname`, reading metadata only
+    """
+    from mutagen.easyid3 import EasyID3
+    from mutagen.flac import FLAC
+    from mutagen.id3 import ID3NoHeaderError
+    if _is_flac(fname):
+        tags = FLAC(fname).tags
+        return {} if tags is None else {
+            k.lower(): v for k, v in tags.as_dict().items()}
+    try:
+        # Reads ID3 header only, not the audio frames.
+        etags = EasyID3(fname)
+    except ID3NoHeaderError:
+        return {}
+    return {k: list(v) for k, v in etags.items()}
+
+
+def read_embedded_art(fname):
+    """ Return (picture data, mime type) for front cover in `fname`, or None
+    """
+    from mutagen.flac import FLAC
+    from mutagen.id3 import ID3, ID3NoHeaderError
+    if _is_flac(fname):
+        pictures = FLAC(fname).pictures
+    else:
+        try:
+            pictures = ID3(fname).getall('APIC')
+        except ID3NoHeaderError:
+            return None
+    if len(pictures := [p for p in pictures if p.data]) == 0:
+        return None
+    # Prefer front cover (picture type 3).
+    pic = sorted(pictures, key=lambda p : p.type != 3)[0]
+    return pic.data, pic.mime
+
+
+def slugify(name):
+    return re.sub(r'[^a-z0-9]+', '_', name.lower()).strip('_')
+
+
+def write_album_art(album_dir, fnames, img_path, out_root):
+    """ Write album art for audio files `fnames` in `album_dir` to `img_path`
+
+    Use embedded art from the first of `fnames` that has some, otherwise a
+    cover image in `album_dir`.  Return basename of image file written, or
+    None if we found no art.
+    """
+    for fname in fnames:
+        if (art := read_embedded_art(fname)) is not None:
+            data, mime = art
+            ext = '.png' if mime == 'image/png' else '.jpg'
+            img_fname = op.join(img_path, out_root + ext)
+            with open(img_fname, 'wb') as fobj:
+                fobj.write(data)
+            return op.basename(img_fname)
+    for cover_base in COVER_BASENAMES:
+        if op.isfile(cover_fname := op.join(album_dir, cover_base)):
+            img_fname = op.join(img_path, out_root + '.jpg')
+            shutil.copyfile(cover_fname, img_fname)
+            return op.basename(img_fname)
+    return None
+
+
+def _unique_name(name, taken):
+    out, i = name, 1
+    while out in taken:
+        i += 1
+        out = f'{name}_{i}'
+    return out
+
+
+def import_tree(root, img_path, n_workers=4, tracks=None, force=False,
+                wav_paths=None):
+    """ Make track configs from tags of audio files in tree `root`
+
+    Parameters
+    ----------
+    root : str
+        Directory containing audio files, in any subdirectory.
+    img_path : str
+        Directory to which to write album art, extracted once per album
+        directory.  We never overwrite existing files in `img_path`.
+    n_workers : int, optional
+        Number of threads for reading tags.
+    tracks : None or dict, optional
+        Existing track configurations.  We skip files with keys in `tracks`,
+        and reuse folder and image names for their albums.
+    force : bool, optional
+        If True, import files even if their keys are in `tracks`.
+    wav_paths : None or sequence, optional
+        Paths in which builds will search for track keys.  We raise an error
+        if a key would find a different file than the one in `root`, e.g.
+        from an earlier import of an archive with the same layout.  None
+        means ``[root]``.
+
+    Returns
+    -------
+    new_tracks : dict
+        Track configurations, with keys being paths of audio files relative
+        to `root`.  Tracks have ``img_fname`` of None for albums where we
+        found no art.
+    """
+    tracks = {} if tracks is None else tracks
+    wav_paths = [root] if wav_paths is None else list(wav_paths)
+    if root not in wav_paths:
+        wav_paths.append(root)
+
+    def resolve(key):
+        try:
+            return op.realpath(find_file(key, wav_paths))
+        except RuntimeError:
+            return None
+
+    by_album = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        if (fnames := [op.join(dirpath, fn) for fn in sorted(filenames)
+                       if op.splitext(fn)[1].lower() in IMPORT_EXTS]):
+            by_album[dirpath] = fnames
+    keys = {fname: op.relpath(fname, root).replace(os.sep, '/')
+            for fnames in by_album.values() for fname in fnames}
+    if (clashes := [key for fname, key in keys.items()
+                    if resolve(key) != op.realpath(fname)]):
+        raise RuntimeError(
+            f'Keys for files in {root} would find other files: ' +
+            ', '.join(clashes[:5]) + (', ...' if len(clashes) > 5 else ''))
+    to_import = {d: [f for f in fnames if force or keys[f] not in tracks]
+                 for d, fnames in by_album.items()}
+    to_import = {d: fnames for d, fnames in to_import.items() if fnames}
+    # Folder and image names from albums from `root` already in config.
+    known = {op.dirname(key): config for key, config in tracks.items()
+             if config.get('folder_name') and
+             resolve(key) == op.realpath(op.join(root, key))}
+    taken_folders = {c.get('folder_name') for c in tracks.values()}
+    ensure_dir(img_path)
+    taken_imgs = {op.splitext(n)[0] for n in os.listdir(img_path)}
+    taken_imgs.update(op.splitext(c['img_fname'])[0] for c in tracks.values()
+                      if c.get('img_fname'))
+    folder_names, img_fnames, img_roots = {}, {}, {}
+    for d in to_import:
+        rel_dir = op.relpath(d, root).replace(os.sep, '/')
+        if (config := known.get('' if rel_dir == '.' else rel_dir)):
+            folder_names[d] = config['folder_name']
+            if (img_fname := config.get('img_fname')):
+                img_fnames[d] = img_fname
+                continue
+        else:
+            # Different directories can have the same slug.
+            folder_names[d] = _unique_name(
+                slugify(rel_dir) or slugify(op.basename(d)), taken_folders)
+            taken_folders.add(folder_names[d])
+        img_roots[d] = _unique_name(folder_names[d], taken_imgs)
+        taken_imgs.add(img_roots[d])
+    with ThreadPoolExecutor(n_workers) as pool:
+        img_fnames.update(zip(img_roots, pool.map(
+            lambda d : write_album_art(d, to_import[d], img_path,
+                                       img_roots[d]),
+            img_roots)))
+        fnames = [f for fnames in to_import.values() for f in fnames]
+        all_tags = dict(zip(fnames, pool.map(read_import_tags, fnames)))
+    new_tracks = {}
+    for d, fnames in to_import.items():
+        for fname in fnames:
+            entry = {'folder_name': folder_names[d],
+                     'img_fname': img_fnames[d]}
+            entry.update(tags2config(all_tags[fname]))
+            # Untagged files; use order in album, and filename.
+            if 'tracknumber' not in entry:
+                entry['tracknumber'] = by_album[d].index(fname) + 1
+            if 'title' not in entry:
+                entry['title'] = op.splitext(op.basename(fname))[0]
+            new_tracks[keys[fname]] = entry
+    return new_tracks
+
+
+class _NoAliasDumper(yaml.Dumper):
+    # Album tracks can share values; write these out in full.
+
+    def ignore_aliases(self, data):
+        return True
 
 
 def write_config(settings, tracks, config_fname):
-    config = {'settings': settings}
-    config.update(tracks)
+    defaults = default_settings(settings)
+    # Only write settings that differ from defaults.
+    config = {'settings': {k: v for k, v in settings.items()
+                           if k not in defaults or v != defaults[k]}}
+    albums, singles = group_albums(tracks)
+    if albums:
+        config[ALBUMS_KEY] = albums
+    config.update(singles)
     with open(config_fname, 'wt') as fobj:
         yaml.dump(config, fobj,
+                  Dumper=_NoAliasDumper,
                   indent=4,
                   allow_unicode=True,
                   encoding='utf-8',
@@ -389,13 +2164,14 @@ class MBInfo:
         '&fmt=json'
     )
     url_get_kwargs = {}
+    # https://musicbrainz.org/doc/Cover_Art_Archive/API
+    cover_url_fmt = 'https://coverartarchive.org/release/{release_id}/front'
 
     @classmethod
-    def from_release(cls, release_id):
+    def from_release(cls, release_id, getter=http_get):
         # https://musicbrainz.org/doc/MusicBrainz_API
         url = cls.url_fmt.format(release_id=release_id)
-        response = requests.get(url, **cls.url_get_kwargs)
-        return cls(json.loads(response.text))
+        return cls(json.loads(getter(url, **cls.url_get_kwargs)))
 
     def __init__(self, in_dict):
         self._in_dict = in_dict
@@ -516,6 +2292,14 @@ class MBInfo:
     def details(self):
         return None
 
+    @property
+    def cover_url(self):
+        caa = self._in_dict.get('cover-art-archive', {})
+        release_id = self._in_dict.get('id')
+        if not caa.get('front') or release_id is None:
+            return None
+        return self.cover_url_fmt.format(release_id=release_id)
+
 
 class DOInfo(MBInfo):
 
@@ -585,18 +2369,204 @@ class DOInfo(MBInfo):
     def details(self):
         return '\n'.join(self._tracks_with_suffix(self._in_dict['tracklist']))
 
+    @property
+    def cover_url(self):
+        images = self._in_dict.get('images', [])
+        primaries = [i for i in images if i.get('type') == 'primary']
+        for image in primaries + images:
+            if (uri := image.get('uri')):
+                return uri
+        return None
+
+
+def _dump_key(release_id):
+    key = str(release_id).encode()
+    if len(key) > DUMP_KEY_WIDTH:
+        raise ValueError(f'Release id {release_id} is too long')
+    return key
+
+
+def index_dump(dump_fname, index_fname=None):
+    """ Write index of release id to byte offset for JSON-lines dump
+
+    Parameters
+    ----------
+    dump_fname : str
+        Filename of dump, with one JSON release record per line, where each
+        record has an "id" key.
+    index_fname : None or str, optional
+        Filename for index.  Default is `dump_fname` with `DUMP_INDEX_EXT`
+        appended.
+
+    Returns
+    -------
+    n_releases : int
+        Number of releases indexed.
+    """
+    if index_fname is None:
+        index_fname = dump_fname + DUMP_INDEX_EXT
+    records = []
+    offset = 0
+    with open(dump_fname, 'rb') as fobj:
+        for line in fobj:
+            if line.strip():
+                records.append(DUMP_RECORD.pack(
+                    _dump_key(json.loads(line)['id']), offset))
+            offset += len(line)
+    # Packed records sort by padded key.
+    records.sort()
+    tmp_fname = index_fname + PARTIAL_EXT
+    with open(tmp_fname, 'wb') as fobj:
+        fobj.write(b''.join(records))
+    os.replace(tmp_fname, index_fname)
+    return len(records)
+
+
+class ReleaseDump:
+    """ Look up releases in indexed JSON-lines dump
+
+    We memory map the dump and the index from `index_dump`, and parse only
+    the record for each release we look up.
+
+    Parameters
+    ----------
+    dump_fname : str
+        Filename of dump.
+    index_fname : None or str, optional
+        Filename of index.  Default is `dump_fname` with `DUMP_INDEX_EXT`
+        appended.
+    """
+
+    def __init__(self, dump_fname, index_fname=None):
+        if index_fname is None:
+            index_fname = dump_fname + DUMP_INDEX_EXT
+        if not op.isfile(index_fname):
+            raise RuntimeError(f'No index {index_fname}; '
+                               f'run "index-dump {dump_fname}" first')
+        self.dump_fname = dump_fname
+        self._dump = self._map(dump_fname)
+        self._index = self._map(index_fname)
+        self._n = len(self._index) // DUMP_RECORD.size
+
+    def _map(self, fname):
+        with open(fname, 'rb') as fobj:
+            if op.getsize(fname) == 0:
+                return b''
+            return mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self._n
+
+    def _record(self, i):
+        return DUMP_RECORD.unpack_from(self._index, i * DUMP_RECORD.size)
+
+    def offset_for(self, release_id):
+        """ Byte offset of record for `release_id` in dump
+        """
+        key = DUMP_RECORD.pack(_dump_key(release_id), 0)[:DUMP_KEY_WIDTH]
+        lo, hi = 0, self._n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._record(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self._n or (record := self._record(lo))[0] != key:
+            raise KeyError(release_id)
+        return record[1]
+
+    def get(self, release_id):
+        """ Return release dictionary for `release_id`
+        """
+        offset = self.offset_for(release_id)
+        end = self._dump.find(b'\n', offset)
+        return json.loads(self._dump[offset:None if end == -1 else end])
+
+
+def fetch_art(fill_objs, img_path, n_workers=4, session=None):
+    """ Fetch front cover art for releases, store by content hash
+
+    Parameters
+    ----------
+    fill_objs : dict
+        Dictionary with release ids as keys, and `MBInfo` or `DOInfo`
+        instances as values.
+    img_path : str
+        Directory in which to store images.  We name each image with the
+        hash of its contents, so identical images share one file.
+    n_workers : int, optional
+        Number of concurrent downloads.
+    session : None or BuildSession, optional
+        Session with HTTP cache.
+
+    Returns
+    -------
+    img_fnames : dict
+        Dictionary with release ids as keys, and image basenames as values,
+        for releases where we found art.
+    """
+    session = BuildSession() if session is None else session
+    urls = {rel_id: url for rel_id, obj in fill_objs.items()
+            if (url := obj.cover_url) is not None}
+    # Discogs image downloads need the same headers as the API.
+    get_kwargs = {obj.cover_url: obj.url_get_kwargs
+                  for obj in fill_objs.values()}
+
+    def fetch(url):
+        try:
+            data = session.http_get(url, **get_kwargs[url])
+        except requests.RequestException as e:
+            # Includes connection errors and timeouts; skip this cover.
+            print(f'Could not get image from {url}: {e}')
+            return None
+        try:
+            img = Image.open(BytesIO(data))
+            img.verify()
+        except (UnidentifiedImageError, OSError):
+            print(f'Could not read image from {url}')
+            return None
+        ext = '.png' if img.format == 'PNG' else '.jpg'
+        img_fname = op.join(img_path, hashlib.md5(data).hexdigest() + ext)
+        if not op.isfile(img_fname):
+            with open(img_fname, 'wb') as fobj:
+                fobj.write(data)
+        return op.basename(img_fname)
+
+    ensure_dir(img_path)
+    unique_urls = sorted(set(urls.values()))
+    with ThreadPoolExecutor(n_workers) as pool:
+        url2fname = dict(zip(unique_urls, pool.map(fetch, unique_urls)))
+    return {rel_id: fname for rel_id, url in urls.items()
+            if (fname := url2fname[url]) is not None}
+
 
 def fill_tracks(wrapper,
                 tracks,
                 track_spec,
                 release_spec=None,
                 force=False,
+                session=None,
+                img_path=None,
+                dump=None,
                ):
+    session = BuildSession() if session is None else session
+
+    def get_fill_obj(rel_id):
+        if dump is None:
+            return wrapper.from_release(rel_id, session.http_get)
+        try:
+            return wrapper(dump.get(rel_id))
+        except KeyError:
+            raise RuntimeError(
+                f'Release {rel_id} not in dump {dump.dump_fname}')
+
     new_tracks = deepcopy(tracks)
     fill_obj = (None if release_spec is None
-                else wrapper.from_release(release_spec))
+                else get_fill_obj(release_spec))
     rel_id_key = wrapper.release_id_key
     done_key = wrapper.filled_flag_key
+    fill_objs = {}
+    rel_ids = {}
     for key, track_info in new_tracks.items():
         if not fnmatch(key, track_spec):
             continue
@@ -605,7 +2575,7 @@ def fill_tracks(wrapper,
         if release_spec is None:
             if not (rel_id := track_info.get(rel_id_key)):
                 continue
-            fill_obj = wrapper.from_release(rel_id)
+            fill_obj = get_fill_obj(rel_id)
         else:
             rel_id = release_spec
         print(f'Filling {key} from {rel_id}')
@@ -613,14 +2583,131 @@ def fill_tracks(wrapper,
         new_info[rel_id_key] = rel_id
         new_info[done_key] = True
         new_tracks[key].update(new_info)
+        METRICS.incr('tracks_filled')
+        METRICS.event('fill', track=key, release=str(rel_id))
+        fill_objs[rel_id] = fill_obj
+        rel_ids[key] = rel_id
+    if img_path is None:
+        return new_tracks
+    img_fnames = fetch_art(fill_objs, img_path, session=session)
+    for key, rel_id in rel_ids.items():
+        if rel_id not in img_fnames:
+            continue
+        if force or not new_tracks[key].get('img_fname'):
+            new_tracks[key]['img_fname'] = img_fnames[rel_id]
     return new_tracks
 
 
+class Library:
+    """ Tracks and settings from a config, for repeated use in one process
+
+    The library keeps a `BuildSession` with its caches for file lookups,
+    stored parameters, processed images and HTTP responses across calls.
+    Methods are serialized with a lock, so the library can be shared between
+    threads of a long-running process.
+
+    Parameters
+    ----------
+    settings : dict
+        Settings, as returned from `proc_config`.
+    tracks : dict
+        Track configurations, as returned from `proc_config`.
+    config_fname : None or str, optional
+        Configuration file from which `settings` and `tracks` came.
+    """
+
+    def __init__(self, settings, tracks, config_fname=None):
+        self.settings = settings
+        self.tracks = tracks
+        self.config_fname = config_fname
+        self.session = BuildSession()
+        self._lock = threading.RLock()
+        self._config_mtime = (None if config_fname is None
+                              else op.getmtime(config_fname))
+
+    @classmethod
+    def from_config(cls, config_fname):
+        config = read_config(config_fname)
+        settings, tracks = proc_config(config, op.dirname(config_fname))
+        return cls(settings, tracks, config_fname)
+
+    def reload(self):
+        """ Reread config file if it has changed since last read
+
+        Returns True if config was reread.
+        """
+        with self._lock:
+            if self.config_fname is None:
+                return False
+            if (mtime := op.getmtime(self.config_fname)) == self._config_mtime:
+                return False
+            self.settings, self.tracks = proc_config(
+                read_config(self.config_fname),
+                op.dirname(self.config_fname))
+            self._config_mtime = mtime
+            self.session.clear()
+            return True
+
+    def select(self, spec='*'):
+        return {k: v for k, v in self.tracks.items() if fnmatch(k, spec)}
+
+    def plan(self, spec='*'):
+        """ Return list of (track, output filename) needing a build
+        """
+        out = []
+        with self._lock:
+            for fbase, config in self.select(spec).items():
+                entry, in_img_fname, full_out_fname = track_out_for(
+                    fbase, config, self.settings)
+                exp_params = exp_params_for(
+                    self.session.find_file(fbase, self.settings['wav_paths']),
+                    self.session.find_file(in_img_fname,
+                                           self.settings['img_paths']),
+                    entry,
+                    self.session,
+                    art_params_for(self.settings))
+                if not same_params_for(exp_params, full_out_fname):
+                    out.append((fbase, full_out_fname))
+        return out
+
+    def build(self, spec='*', force=False):
+        """ Build tracks matching `spec`, return list of tracks built
+        """
+        with self._lock:
+            return build_tracks(self.select(spec), self.settings, force,
+                                session=self.session,
+                                all_tracks=self.tracks)
+
+    def fill(self, spec, release=None, wrapper=MBInfo, force=False,
+             fetch_art=False, dump=None):
+        """ Fill track info for tracks matching `spec` from `wrapper`
+        """
+        with self._lock:
+            self.tracks = fill_tracks(
+                wrapper, self.tracks, spec, release,
+                force=force, session=self.session,
+                img_path=(self.settings['img_paths'][0] if fetch_art
+                          else None),
+                dump=dump)
+        return self.tracks
+
+    def write_config(self, config_fname=None):
+        with self._lock:
+            if config_fname is None:
+                config_fname = self.config_fname
+            write_config(self.settings, self.tracks, config_fname)
+            if config_fname == self.config_fname:
+                self._config_mtime = op.getmtime(config_fname)
+
+
 def get_parser():
     parser = ArgumentParser(description=__doc__,  # Usage from docstring
                             formatter_class=RawDescriptionHelpFormatter)
     parser.add_argument('action',
-                        help='one of "default-config", "mb-config", "build"')
+                        help='one of "default-config", "mb-config", '
+                        '"do-config", "build", "sync", "gc", "verify", '
+                        '"import", "dupes", "worker", "cache-server", '
+                        '"query", "index-dump", "compact-config"')
     parser.add_argument('first_arg', nargs='?',
                         help='Argument, meaning depends on "action"')
     parser.add_argument('second_arg', nargs='?',
@@ -630,12 +2717,66 @@ def get_parser():
                         help='Path to config file')
     parser.add_argument('--force', action='store_true',
                         help='Whether to overwrite existing files/parameters')
+    parser.add_argument('--keep-orphans', action='store_true',
+                        help='For "sync", do not delete files from earlier '
+                        'syncs that are no longer in the output folder')
+    parser.add_argument('--fetch-art', action='store_true',
+                        help='For "mb-config", "do-config", fetch front '
+                        'cover art into first of "img_paths"')
+    parser.add_argument('--dump',
+                        help='For "mb-config", "do-config", use this '
+                        'indexed JSON-lines release dump instead of the '
+                        'network')
+    parser.add_argument('--check-hashes', action='store_true',
+                        help='For "verify", also check output file hashes')
+    parser.add_argument('--metrics-jsonl',
+                        help='Append JSON-lines metric events to this file')
+    parser.add_argument('--metrics-prom',
+                        help='Write Prometheus textfile metrics to this file')
     return parser
 
 
 def main():
     parser = get_parser()
     args = parser.parse_args()
+    METRICS.jsonl_fname = args.metrics_jsonl
+    try:
+        return run_action(args)
+    finally:
+        if args.metrics_prom:
+            METRICS.write_prom(args.metrics_prom)
+
+
+def run_action(args):
+    # Workers do not need a config file.
+    if args.action == 'worker':
+        # Listen on other interfaces only if asked.
+        address = parse_address(args.first_arg or f'127.0.0.1:{WORKER_PORT}')
+        # Restrict to configured parameters, if there is a config.
+        allowed_params = (
+            read_config(args.config_path).get('settings', {}).get(
+                'sox_params')
+            if op.isfile(args.config_path) else None)
+        with EncodeServer(address, allowed_params=allowed_params) as server:
+            print('Encode worker listening on {}:{}'.format(
+                *server.server_address))
+            server.serve_forever()
+        return 0
+    if args.action == 'cache-server':
+        if args.first_arg is None:
+            raise RuntimeError('Need directory for cache')
+        address = parse_address(args.second_arg or '0.0.0.0:8000', 8000)
+        with store_server(args.first_arg, address) as server:
+            print('Cache server listening on {}:{}'.format(
+                *server.server_address))
+            server.serve_forever()
+        return 0
+    if args.action == 'index-dump':
+        if args.first_arg is None:
+            raise RuntimeError('Need dump filename')
+        n_releases = index_dump(args.first_arg, args.second_arg)
+        print(f'Indexed {n_releases} releases')
+        return 0
     config = read_config(args.config_path)
     settings, tracks = proc_config(
         config,
@@ -654,19 +2795,105 @@ def main():
                              tracks,
                              args.first_arg,
                              args.second_arg,
-                             force=args.force)
+                             force=args.force,
+                             img_path=(settings['img_paths'][0]
+                                       if args.fetch_art else None),
+                             dump=(None if args.dump is None
+                                   else ReleaseDump(args.dump)))
         write_config(settings, tracks, args.config_path)
         return 0
     if args.action == 'build':
-        for track, config in tracks.items():
-            print('Building', track)
-            build_one(track, config, settings, args.force)
+        build_tracks(tracks, settings, args.force, verbose=True)
+        if settings['catalog_fname'] is not None:
+            Catalog(settings['catalog_fname']).prune(tracks)
+        gauges = METRICS.gauges()
+        print(f"Built {METRICS.since_start('tracks_built')} tracks in "
+              f"{gauges['elapsed_seconds']:.1f}s "
+              f"({gauges['tracks_per_second']:.2f} tracks/s)")
+        return 0
+    if args.action == 'sync':
+        if (sync_path := args.first_arg or settings.get('sync_path')) is None:
+            raise RuntimeError('Need sync path argument or setting')
+        copied, deleted = sync_tree(settings['out_path'],
+                                    sync_path,
+                                    settings['n_workers'],
+                                    delete=not args.keep_orphans)
+        for rel in copied:
+            print('Copied', rel)
+        for rel in deleted:
+            print('Deleted', rel)
+        return 0
+    if args.action == 'gc':
+        removed, missing = gc_conv_cache(tracks, settings)
+        for fbase in missing:
+            print('Missing input', fbase)
+        for fname in removed:
+            print('Removed', fname)
+        return 0
+    if args.action == 'verify':
+        drift = verify_tracks(tracks, settings,
+                              check_hash=args.check_hashes,
+                              n_workers=settings['n_workers'])
+        for track, problems in drift.items():
+            for problem in problems:
+                print(f'{track}: {problem}')
+        return 1 if drift else 0
+    if args.action == 'import':
+        if args.first_arg is None:
+            raise RuntimeError('Need directory to import')
+        root = op.abspath(args.first_arg)
+        new_tracks = import_tree(root,
+                                 settings['img_paths'][0],
+                                 settings['n_workers'],
+                                 tracks,
+                                 args.force,
+                                 settings['wav_paths'])
+        for key, entry in new_tracks.items():
+            print('Importing', key)
+            tracks[key] = entry
+        for folder_name in sorted({e['folder_name'] for e in
+                                   new_tracks.values()
+                                   if e['img_fname'] is None}):
+            print(f'No album art for {folder_name}; add an image to '
+                  '"img_paths" and set "img_fname"')
+        if root not in settings['wav_paths']:
+            settings['wav_paths'].append(root)
+        write_config(settings, tracks, args.config_path)
+        return 0
+    if args.action == 'dupes':
+        groups = dupes_report(tracks, settings)
+        for group in groups:
+            print('Duplicate inputs:')
+            used = [fname for fname, users in group if users]
+            for fname, users in group:
+                note = ('not in config' if not users else
+                        'redundant' if fname != used[0] else 'kept')
+                print(f'    {fname} ({note}):', ', '.join(users))
+        return 1 if groups else 0
+    if args.action == 'query':
+        if args.first_arg is None:
+            raise RuntimeError(
+                'Need query, e.g. "composer=*Bach;style=Choral"')
+        catalog = Catalog(settings['catalog_fname'], create=False)
+        rows = catalog.query(**parse_query(args.first_arg))
+        if args.second_arg is None:
+            write_m3u(rows, sys.stdout)
+        else:
+            with open(args.second_arg, 'wt') as fobj:
+                write_m3u(rows, fobj,
+                          op.dirname(op.abspath(args.second_arg)))
+        return 0
+    if args.action == 'compact-config':
+        # Rewrite config with album blocks and non-default settings only.
+        write_config(settings, tracks, args.config_path)
         return 0
     else:
         raise RuntimeError(
             'Expecting one of'
-            '"default-config", "mb-config", "do-config", "build"')
+            '"default-config", "mb-config", "do-config", "build", "sync", '
+            '"gc", "verify", "import", "dupes", "worker", "cache-server", '
+            '"query", "index-dump", "compact-config"')
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -3,13 +3,38 @@
 
 import os
 import os.path as op
+import sys
 import shutil
+import subprocess
+import json
+import socket
+import threading
+import hashlib
+from copy import deepcopy
 from datetime import date as Date
 from glob import glob
+from io import BytesIO, StringIO
+
+from PIL import Image
+from mutagen.id3 import ID3, APIC
+import requests
 
 from amusic import (MBInfo, DOInfo,
                     strip_nones, read_config, stored_params_for,
-                    proc_config, build_one, clear_params)
+                    write_params_for,
+                    proc_config, build_one, clear_params,
+                    sync_tree, read_manifest, conv_key_for,
+                    conv_cache_entries, evict_conv_cache, Metrics,
+                    METRICS, same_params_for, Library, BuildSession,
+                    verify_tracks, write_tags, tags2config, import_tree,
+                    find_dupes, dupes_report, EncodeServer, RemoteEncoder,
+                    file_md5, build_tracks, DirStore, HTTPStore,
+                    store_server, convert_file, write_proc_image,
+                    conv_fname_for, read_embedded_art, Catalog,
+                    parse_query, write_m3u, fill_tracks, index_dump,
+                    ReleaseDump, write_config, group_albums,
+                    resolve_albums, gc_conv_cache, write_converted_file,
+                    fetch_art)
 
 
 import pytest
@@ -232,3 +257,801 @@ def test_build_one():
     # Clear input file hashes
     clear_params('wavs')
     clear_params('images')
+
+
+def _write_file(fname, contents):
+    os.makedirs(op.dirname(fname), exist_ok=True)
+    with open(fname, 'wt') as fobj:
+        fobj.write(contents)
+
+
+def test_sync_tree(tmp_path):
+    src = str(tmp_path / 'src')
+    dst = str(tmp_path / 'dst')
+    _write_file(op.join(src, 'album1', 'side01.mp3'), 'one')
+    _write_file(op.join(src, 'album1', 'side02.mp3'), 'two')
+    _write_file(op.join(src, 'album2', 'side01.mp3'), 'three')
+    copied, deleted = sync_tree(src, dst)
+    assert copied == ['album1/side01.mp3', 'album1/side02.mp3',
+                      'album2/side01.mp3']
+    assert deleted == []
+    with open(op.join(dst, 'album2', 'side01.mp3'), 'rt') as fobj:
+        assert fobj.read() == 'three'
+    assert set(read_manifest(dst)) == set(copied)
+    # Nothing to do second time round.
+    assert sync_tree(src, dst) == ([], [])
+    # Changed and new files copied, orphans deleted.
+    _write_file(op.join(src, 'album1', 'side02.mp3'), 'TWO')
+    _write_file(op.join(src, 'album3', 'side01.mp3'), 'four')
+    shutil.rmtree(op.join(src, 'album2'))
+    copied, deleted = sync_tree(src, dst)
+    assert copied == ['album1/side02.mp3', 'album3/side01.mp3']
+    assert deleted == ['album2/side01.mp3']
+    assert not op.exists(op.join(dst, 'album2'))
+    with open(op.join(dst, 'album1', 'side02.mp3'), 'rt') as fobj:
+        assert fobj.read() == 'TWO'
+    # Interrupted sync; no manifest, and a partial copy.
+    os.unlink(op.join(dst, '.amusic_manifest.json'))
+    _write_file(op.join(dst, 'album1', 'side01.mp3.partial'), 'o')
+    assert sync_tree(src, dst) == ([], [])
+    assert not op.exists(op.join(dst, 'album1', 'side01.mp3.partial'))
+    # Files we did not copy are not deleted; params sidecars are not copied.
+    _write_file(op.join(dst, 'other', 'song.mp3'), 'theirs')
+    _write_file(op.join(src, 'album1', 'side01.mp3.json'), '{}')
+    shutil.rmtree(op.join(src, 'album3'))
+    assert sync_tree(src, dst, delete=False) == ([], [])
+    assert op.isfile(op.join(dst, 'album3', 'side01.mp3'))
+    assert sync_tree(src, dst) == ([], ['album3/side01.mp3'])
+    assert not op.exists(op.join(dst, 'album3'))
+    assert op.isfile(op.join(dst, 'other', 'song.mp3'))
+    assert not op.exists(op.join(dst, 'album1', 'side01.mp3.json'))
+
+
+def test_conv_key_for():
+    in_params = {'md5': 'abc'}
+    key = conv_key_for(in_params, ['-C', '320'])
+    assert conv_key_for({'md5': 'abc'}, ['-C', 320]) == key
+    assert conv_key_for(in_params, ['-C', '256']) != key
+    assert conv_key_for({'md5': 'abd'}, ['-C', '320']) != key
+
+
+def test_evict_conv_cache(tmp_path):
+    conv_path = str(tmp_path)
+    for i, name in enumerate(('a', 'b', 'c')):
+        fname = op.join(conv_path, name + '.mp3')
+        _write_file(fname, 'x' * 100)
+        write_params_for({'md5': name}, fname)
+        # Make "a" the most recently used.
+        mtime = 1000 + (3 - i if name == 'a' else i) * 10
+        os.utime(fname + '.json', (mtime, mtime))
+    _write_file(op.join(conv_path, 'other.txt'), 'y' * 1000)
+    entries = conv_cache_entries(conv_path, '.mp3')
+    assert [op.basename(e[2]) for e in entries] == ['b.mp3', 'c.mp3', 'a.mp3']
+    assert evict_conv_cache(conv_path, '.mp3', 300) == []
+    removed = evict_conv_cache(conv_path, '.mp3', 150)
+    assert [op.basename(f) for f in removed] == ['b.mp3', 'c.mp3']
+    assert not op.exists(op.join(conv_path, 'b.mp3.json'))
+    assert op.isfile(op.join(conv_path, 'a.mp3'))
+    assert op.isfile(op.join(conv_path, 'other.txt'))
+
+
+def test_gc_conv_cache(tmp_path):
+    settings, tracks = _tmp_library(tmp_path)
+    fbase, config = list(tracks.items())[0]
+    build_one(fbase, config, settings)
+    used = conv_fname_for(op.join(settings['wav_paths'][0], fbase), settings)
+    stale = op.join(settings['conv_path'], 'stale' + settings['conv_ext'])
+    _write_file(stale, 'old')
+    # Missing inputs reported; other entries still kept.
+    tracks['no_such.wav'] = config
+    assert gc_conv_cache(tracks, settings) == ([stale], ['no_such.wav'])
+    assert op.isfile(used)
+
+
+def test_metrics(tmp_path):
+    jsonl_fname = str(tmp_path / 'events.jsonl')
+    metrics = Metrics(jsonl_fname)
+    metrics.incr('tracks_built')
+    metrics.incr('bytes_encoded', 1000)
+    assert metrics.hit('same_params', True)
+    assert not metrics.hit('same_params', False)
+    metrics.hit('same_params', True)
+    with metrics.timer('sox'):
+        pass
+    metrics.event('track', track='foo.wav', built=True)
+    assert metrics.counters['tracks_built'] == 1
+    assert metrics.counters['bytes_encoded'] == 1000
+    assert metrics.counters['same_params_hits'] == 2
+    assert metrics.counters['same_params_misses'] == 1
+    assert metrics.counters['sox_seconds'] >= 0
+    assert metrics.gauges()['same_params_hit_rate'] == 2 / 3
+    with open(jsonl_fname, 'rt') as fobj:
+        events = [json.loads(line) for line in fobj]
+    assert len(events) == 1
+    assert events[0]['event'] == 'track'
+    assert events[0]['track'] == 'foo.wav'
+    prom_fname = str(tmp_path / 'amusic.prom')
+    metrics.write_prom(prom_fname)
+    with open(prom_fname, 'rt') as fobj:
+        lines = fobj.read().splitlines()
+    assert '# TYPE amusic_tracks_built_total counter' in lines
+    assert 'amusic_tracks_built_total 1' in lines
+    assert 'amusic_bytes_encoded_total 1000' in lines
+    assert '# TYPE amusic_same_params_hit_rate gauge' in lines
+    assert any(L.startswith('amusic_tracks_per_second ') for L in lines)
+    # Rates are for the run since the last start.
+    metrics.start()
+    assert metrics.since_start('tracks_built') == 0
+    assert metrics.gauges()['tracks_per_second'] == 0
+    metrics.incr('tracks_built', 2)
+    assert metrics.since_start('tracks_built') == 2
+    assert metrics.counters['tracks_built'] == 3
+
+
+def test_same_params_metrics(tmp_path):
+    fname = str(tmp_path / 'out.mp3')
+    _write_file(fname, 'audio')
+    METRICS.reset()
+    assert not same_params_for({'a': 1}, fname)
+    write_params_for({'a': 1}, fname)
+    assert same_params_for({'a': 1}, fname)
+    assert not same_params_for({'a': 2}, fname)
+    assert METRICS.counters['same_params_hits'] == 1
+    assert METRICS.counters['same_params_misses'] == 2
+    assert METRICS.counters['stored_params_hits'] == 2
+    assert METRICS.counters['stored_params_misses'] == 1
+
+
+def test_library_plan():
+    config_fname = op.join(HERE, 'amusic_config.yml')
+    library = Library.from_config(config_fname)
+    assert list(library.select()) == ['aclip.wav']
+    assert library.select('foo*') == {}
+    # No stored params for output, so track needs a build.
+    plan = library.plan()
+    assert len(plan) == 1
+    track, out_fname = plan[0]
+    assert track == 'aclip.wav'
+    assert out_fname == op.join('amusic_tmp', 'berlioz_funebre',
+                                'berlioz_funebre_side01.mp3')
+    assert library.plan('foo*') == []
+    # Config unchanged, no reload.
+    assert not library.reload()
+
+
+def test_build_session(tmp_path):
+    img_path = str(tmp_path)
+    img_fname = op.join(img_path, 'brown_team.jpg')
+    shutil.copyfile(op.join(HERE, 'images', 'brown_team.jpg'), img_fname)
+    session = BuildSession()
+    assert session.find_file('brown_team.jpg', [img_path]) == img_fname
+    with pytest.raises(RuntimeError):
+        session.find_file('no_such.jpg', [img_path])
+    METRICS.reset()
+    params, data = session.proc_image(img_fname, (600, 400), 512)
+    assert params == session.stored_params_for(img_fname)
+    # Image processed only once.
+    assert session.proc_image(img_fname, (600, 400), 512) == (params, data)
+    assert METRICS.counters['images_processed'] == 1
+    session.proc_image(img_fname, (600, 400), 256)
+    assert METRICS.counters['images_processed'] == 2
+    session.clear()
+    session.proc_image(img_fname, (600, 400), 256)
+    assert METRICS.counters['images_processed'] == 3
+
+
+def test_session_conversion(tmp_path):
+    settings, tracks = _tmp_library(tmp_path)
+    in_fname = op.join(settings['wav_paths'][0], list(tracks)[0])
+    out_fname = str(tmp_path / 'out.mp3')
+    session = BuildSession()
+    params = write_converted_file(in_fname, out_fname, settings,
+                                  params_getter=session.stored_params_for)
+    METRICS.reset()
+    assert write_converted_file(
+        in_fname, out_fname, settings,
+        params_getter=session.stored_params_for) == params
+    assert METRICS.counters['conversion_hits'] == 1
+    # Input and cache entry params cached in session.
+    conv_fname = conv_fname_for(in_fname, settings)
+    assert set(session._params) == {in_fname, conv_fname}
+
+
+def test_build_session_http(tmp_path):
+    srv_path = str(tmp_path / 'srv')
+    server = store_server(srv_path, ('127.0.0.1', 0))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = 'http://{}:{}'.format(*server.server_address)
+    session = BuildSession()
+    session.max_cached = 2
+    try:
+        # Errors raise, and are not cached.
+        with pytest.raises(requests.HTTPError):
+            session.http_get(base_url + '/a')
+        for name in 'abc':
+            _write_file(op.join(srv_path, name), name)
+        METRICS.reset()
+        assert session.http_get(base_url + '/a') == b'a'
+        assert session.http_get(base_url + '/a') == b'a'
+        assert METRICS.counters['http_requests'] == 1
+        session.http_get(base_url + '/b')
+        session.http_get(base_url + '/c')
+        # Oldest response dropped from cache.
+        assert len(session._http) == 2
+        session.http_get(base_url + '/a')
+        assert METRICS.counters['http_requests'] == 4
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _tmp_library(tmp_path):
+    # Copy of test config, inputs and outputs in `tmp_path`.
+    config = read_config(op.join(HERE, 'amusic_config.yml'))
+    settings, tracks = proc_config(config, HERE)
+    for name in ('wavs', 'images'):
+        shutil.copytree(op.join(HERE, name), str(tmp_path / name))
+    for key in ('wav_paths', 'img_paths'):
+        settings[key] = [str(tmp_path / p) for p in settings[key]]
+    for key in ('out_path', 'conv_path'):
+        settings[key] = str(tmp_path / settings[key])
+    return settings, tracks
+
+
+def _run_amusic(*args):
+    # Exit code from running amusic.py as a script.
+    return subprocess.run([sys.executable, op.join(HERE, 'amusic.py')] +
+                          list(args), capture_output=True).returncode
+
+
+def test_verify(tmp_path):
+    settings, tracks = _tmp_library(tmp_path)
+    fbase, config = list(tracks.items())[0]
+    assert verify_tracks(tracks, settings) == {
+        fbase: [f'missing {settings["out_path"]}/berlioz_funebre/'
+                'berlioz_funebre_side01.mp3']}
+    config_fname = str(tmp_path / 'amusic_config.yml')
+    write_config(settings, tracks, config_fname)
+    assert _run_amusic('verify', '--config-path', config_fname) == 1
+    build_one(fbase, config, settings)
+    assert verify_tracks(tracks, settings, check_hash=True) == {}
+    assert _run_amusic('verify', '--config-path', config_fname) == 0
+    # Verify does not write image hashes.
+    img_fname = op.join(settings['img_paths'][0], config['img_fname'])
+    os.unlink(img_fname + '.json')
+    assert verify_tracks(tracks, settings)[fbase] == [
+        'stored params differ from inputs / config']
+    assert not op.exists(img_fname + '.json')
+    build_one(fbase, config, settings, force=True)
+    # Change in config shows as drift.
+    config['conductor'] = 'Hermann Scherchen'
+    drift = verify_tracks(tracks, settings)[fbase]
+    assert drift[0] == 'stored params differ from inputs / config'
+    assert drift[1] == ("TPE3: expected 'Hermann Scherchen', "
+                        "found 'Fritz Straub'")
+    assert len(drift) == 2
+    # Tags changed in output file.
+    config['conductor'] = 'Fritz Straub'
+    out_fname = glob(op.join(settings['out_path'], '*', '*.mp3'))[0]
+    entry = {k: v for k, v in config.items()
+             if k not in ('folder_name', 'img_fname')}
+    entry['album'] = 'Eldorado'
+    write_tags(out_fname, entry, b'')
+    drift = verify_tracks(tracks, settings)[fbase]
+    assert drift[0].startswith("APIC:cover_front: expected 'md5:")
+    assert drift[0].endswith("found 'md5:d41d8cd98f00b204e9800998ecf8427e'")
+    assert drift[1] == ("TALB: expected 'Symphonie Funèbre et Triomphale Op "
+                        "15', found 'Eldorado'")
+    assert verify_tracks(tracks, settings, check_hash=True)[fbase][-1] == (
+        'output hash differs from stored hash')
+    # Missing inputs reported for the track, other tracks still checked.
+    tracks['no_such.wav'] = dict(config, img_fname='no_such.jpg')
+    problems = verify_tracks(tracks, settings)
+    assert problems['no_such.wav'] == ['missing input no_such.wav',
+                                       'missing input no_such.jpg']
+    assert fbase in problems
+
+
+def test_tags2config():
+    assert tags2config({}) == {}
+    assert tags2config({'album': ['Mass'],
+                        'genre': ['Baroque'],
+                        'composer': ['JS Bach'],
+                        'performer': ['Anna', 'Bea'],
+                        'tracknumber': ['3/10'],
+                        'discnumber': ['1'],
+                        'disctotal': ['2'],
+                        'date': ['1994-04-01']}) == {
+                            'album': 'Mass',
+                            'period': 'Baroque',
+                            'composer': 'JS Bach',
+                            'performer': ['Anna', 'Bea'],
+                            'tracknumber': 3,
+                            'tracktotal': 10,
+                            'discnumber': 1,
+                            'disctotal': 2,
+                            'originalyear': 1994}
+
+
+def test_import_tree(tmp_path):
+    root = tmp_path / 'archive'
+    img_path = str(tmp_path / 'images')
+    with open(op.join(HERE, 'images', 'brown_team.jpg'), 'rb') as fobj:
+        img_data = fobj.read()
+    for album, has_art in (('Bach/Mass', True), ('Brahms VC', False)):
+        for track in (1, 2):
+            fname = str(root / album / f'{track:02d}.mp3')
+            os.makedirs(op.dirname(fname), exist_ok=True)
+            shutil.copyfile(op.join(HERE, 'wavs', 'aclip.wav'), fname)
+            write_tags(fname,
+                       {'album': album, 'title': f'Part {track}',
+                        'tracknumber': track},
+                       img_data if has_art else b'')
+    tracks = import_tree(str(root), img_path)
+    assert tracks['Brahms VC/01.mp3']['img_fname'] is None
+    assert os.listdir(img_path) == ['bach_mass.jpg']
+    # Use cover image if no embedded art.
+    shutil.copyfile(op.join(HERE, 'images', 'brown_team.jpg'),
+                    str(root / 'Brahms VC' / 'cover.jpg'))
+    # Nothing new to import, so no art extracted.
+    assert import_tree(str(root), img_path, tracks=tracks) == {}
+    assert os.listdir(img_path) == ['bach_mass.jpg']
+    tracks = import_tree(str(root), img_path, tracks=tracks, force=True)
+    assert list(tracks) == ['Bach/Mass/01.mp3', 'Bach/Mass/02.mp3',
+                            'Brahms VC/01.mp3', 'Brahms VC/02.mp3']
+    assert tracks['Bach/Mass/02.mp3'] == {
+        'folder_name': 'bach_mass',
+        'img_fname': 'bach_mass.jpg',
+        'album': 'Bach/Mass',
+        'title': 'Part 2',
+        'tracknumber': 2}
+    assert tracks['Brahms VC/01.mp3']['folder_name'] == 'brahms_vc'
+    assert tracks['Brahms VC/01.mp3']['img_fname'] == 'brahms_vc.jpg'
+    assert sorted(os.listdir(img_path)) == ['bach_mass.jpg', 'brahms_vc.jpg']
+    with open(op.join(img_path, 'bach_mass.jpg'), 'rb') as fobj:
+        assert fobj.read() == img_data
+    # Same slug for different album; untagged files.
+    for track in (1, 2):
+        fname = str(root / 'Bach Mass' / f'{track:02d}_gloria.mp3')
+        _write_file(fname, 'not tagged')
+    # Art only, no text tags.
+    id3 = ID3()
+    id3.add(APIC(mime='image/jpeg', type=3, data=img_data))
+    id3.save(fname)
+    new_tracks = import_tree(str(root), img_path, tracks=tracks)
+    assert new_tracks == {
+        f'Bach Mass/0{i}_gloria.mp3': {'folder_name': 'bach_mass_2',
+                                       'img_fname': 'bach_mass_2.jpg',
+                                       'tracknumber': i,
+                                       'title': f'0{i}_gloria'}
+        for i in (1, 2)}
+    with open(op.join(img_path, 'bach_mass.jpg'), 'rb') as fobj:
+        assert fobj.read() == img_data
+    # Second archive with same layout; keys would find first archive files.
+    root2 = tmp_path / 'archive2'
+    shutil.copytree(str(root / 'Bach'), str(root2 / 'Bach'))
+    with pytest.raises(RuntimeError, match='Bach/Mass/01.mp3'):
+        import_tree(str(root2), img_path, tracks=tracks,
+                    wav_paths=[str(root)])
+
+
+def test_find_dupes(tmp_path):
+    # Realpath because find_dupes returns real paths.
+    path1 = op.realpath(str(tmp_path / 'captures1'))
+    path2 = op.realpath(str(tmp_path / 'captures2'))
+    block = 2 ** 16
+    contents = {
+        op.join(path1, 'side1.wav'): 'a' * block * 3,
+        op.join(path2, 'side1_again.wav'): 'a' * block * 3,
+        # Same size and same first / last blocks, different middle.
+        op.join(path2, 'side1_edit.wav'): 'a' * block + 'b' + 'a' * (
+            block * 2 - 1),
+        op.join(path2, 'side2.wav'): 'c' * block * 3,
+        op.join(path1, 'side3.wav'): 'd' * 10,
+        op.join(path2, 'sub', 'side3.wav'): 'd' * 10,
+        op.join(path2, 'side4.wav'): 'e' * 10,
+        # Not audio files, or empty.
+        op.join(path1, 'notes.txt'): 'f' * 10,
+        op.join(path2, 'notes.txt'): 'f' * 10,
+        op.join(path1, 'empty.wav'): '',
+        op.join(path2, 'empty.WAV'): '',
+    }
+    for fname, data in contents.items():
+        _write_file(fname, data)
+    groups = find_dupes([path1, path2])
+    assert sorted(groups) == [
+        [op.join(path1, 'side1.wav'), op.join(path2, 'side1_again.wav')],
+        [op.join(path1, 'side3.wav'), op.join(path2, 'sub', 'side3.wav')]]
+    # Only files with matching partial hashes get a full hash.
+    assert stored_params_for(op.join(path1, 'side1.wav')) is not None
+    assert stored_params_for(op.join(path2, 'side1_edit.wav')) is not None
+    assert stored_params_for(op.join(path2, 'side2.wav')) is None
+    assert stored_params_for(op.join(path2, 'side4.wav')) is None
+    settings = {'wav_paths': [path1, path2]}
+    tracks = {'side1.wav': {}, 'side1_again.wav': {}, 'sub/side3.wav': {}}
+    assert sorted(dupes_report(tracks, settings)) == [
+        [(op.join(path1, 'side1.wav'), ['side1.wav']),
+         (op.join(path2, 'side1_again.wav'), ['side1_again.wav'])],
+        [(op.join(path1, 'side3.wav'), []),
+         (op.join(path2, 'sub', 'side3.wav'), ['sub/side3.wav'])]]
+    # Script exits with 1 for duplicates, 0 otherwise.
+    settings = _tmp_library(tmp_path)[0]
+    config_fname = str(tmp_path / 'amusic_config.yml')
+    for wav_paths, exp_code in (([path1], 0), ([path1, path2], 1)):
+        write_config(dict(settings, wav_paths=wav_paths), {}, config_fname)
+        assert _run_amusic('dupes', '--config-path', config_fname) == exp_code
+
+
+# Converter copying input to output, standing in for sox.
+COPY_CONVERTER = (sys.executable, '-c',
+                  'import sys, shutil; '
+                  'shutil.copyfile(sys.argv[1], sys.argv[-1])')
+
+
+def _start_server(converter=COPY_CONVERTER, allowed_params=None):
+    server = EncodeServer(('127.0.0.1', 0), converter, allowed_params)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, '{}:{}'.format(*server.server_address)
+
+
+def _unused_address():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return '{}:{}'.format(*sock.getsockname())
+
+
+def test_remote_encoder(tmp_path):
+    in_fname = op.join(HERE, 'wavs', 'aclip.wav')
+    in_md5 = file_md5(in_fname)
+    servers, addresses = zip(*[_start_server() for i in range(2)])
+    bad_server, bad_address = _start_server(('no_such_command_here',))
+    servers += (bad_server,)
+    try:
+        # Dead and failing workers first; retried on other workers.
+        encoder = RemoteEncoder([_unused_address(), bad_address] +
+                                list(addresses))
+        for i in range(4):
+            out_fname = str(tmp_path / f'out{i}.mp3')
+            encoder.convert(in_fname, out_fname, ['-C', '320'], in_md5)
+            assert file_md5(out_fname) == in_md5
+        assert not glob(str(tmp_path / '*.partial'))
+        # Wrong input hash; workers reject input.
+        with pytest.raises(RuntimeError, match='Input hash mismatch'):
+            encoder.convert(in_fname, str(tmp_path / 'bad.mp3'),
+                            ['-C', '320'], 'not-the-hash')
+        # Workers refuse extra inputs and unsafe parameters.
+        for params in (['-C', '320', '/etc/passwd'], ['-t', 'raw']):
+            with pytest.raises(RuntimeError, match='options or numbers'):
+                encoder.convert(in_fname, str(tmp_path / 'bad.mp3'),
+                                params, in_md5)
+        assert not glob(str(tmp_path / '*.partial'))
+        strict_server, strict_address = _start_server(
+            allowed_params=['-C', 320])
+        servers += (strict_server,)
+        strict = RemoteEncoder([strict_address])
+        strict.convert(in_fname, str(tmp_path / 'strict.mp3'),
+                       ['-C', '320'], in_md5)
+        with pytest.raises(RuntimeError, match='not allowed'):
+            strict.convert(in_fname, str(tmp_path / 'bad.mp3'),
+                           ['-C', '256'], in_md5)
+        # Parallel build of several tracks, each with one encode worker.
+        settings, tracks = _tmp_library(tmp_path)
+        settings['encode_workers'] = list(addresses)
+        fbase, config = list(tracks.items())[0]
+        shutil.copyfile(op.join(settings['wav_paths'][0], fbase),
+                        op.join(settings['wav_paths'][0], 'aclip2.wav'))
+        config2 = dict(config, tracknumber=2)
+        tracks['aclip2.wav'] = config2
+        # Inputs share a conversion cache entry; evicted after the build.
+        settings['conv_cache_mb'] = 0
+        assert build_tracks(tracks, settings) == ['aclip.wav', 'aclip2.wav']
+        assert len(glob(op.join(settings['out_path'], '*', '*.mp3'))) == 2
+        assert os.listdir(settings['conv_path']) == []
+        assert build_tracks(tracks, settings) == []
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+
+def _check_store(store):
+    assert store.get('foo.mp3') is None
+    store.put('foo.mp3', b'some data')
+    assert store.get('foo.mp3') == b'some data'
+    store.put('bar.mp3', b'other data')
+    # Corrupt entry; contents do not match hash.
+    store._write('bar.mp3', b'corrupt data')
+    assert store.get('bar.mp3') is None
+
+
+def test_shared_stores(tmp_path):
+    cache_path = str(tmp_path / 'cache')
+    _check_store(DirStore(cache_path))
+    server = store_server(str(tmp_path / 'http_cache'), ('127.0.0.1', 0))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        _check_store(HTTPStore('http://{}:{}/'.format(
+            *server.server_address)))
+    finally:
+        server.shutdown()
+        server.server_close()
+    # Unreachable store; misses and errors, not exceptions.
+    METRICS.reset()
+    store = HTTPStore(f'http://{_unused_address()}/', timeout=5)
+    store.put('foo.mp3', b'some data')
+    assert store.get('foo.mp3') is None
+    assert METRICS.counters['shared_cache_errors'] == 2
+    assert METRICS.counters['shared_cache_misses'] == 1
+
+
+def test_shared_cache_build(tmp_path):
+    store = DirStore(str(tmp_path / 'shared'))
+    settings, tracks = _tmp_library(tmp_path)
+    in_fname = op.join(settings['wav_paths'][0], 'aclip.wav')
+    img_fname = op.join(settings['img_paths'][0], 'brown_team.jpg')
+    os.makedirs(settings['conv_path'])
+    conv_fname = conv_fname_for(in_fname, settings)
+    # Result of another machine's conversion, in the shared store.
+    store.put(op.basename(conv_fname), b'converted')
+    sox_params = settings['sox_params']
+    METRICS.reset()
+    params = convert_file(in_fname, conv_fname, sox_params, store=store)
+    assert METRICS.counters['shared_cache_hits'] == 1
+    assert 'sox_seconds' not in METRICS.counters
+    with open(conv_fname, 'rb') as fobj:
+        assert fobj.read() == b'converted'
+    assert stored_params_for(conv_fname) == params
+    # Processed images go to the shared store, for use elsewhere.
+    img_params, data = write_proc_image(img_fname, (600, 400), 512, store)
+    assert METRICS.counters['images_processed'] == 1
+    assert write_proc_image(img_fname, (600, 400), 512, store) == (
+        img_params, data)
+    assert METRICS.counters['images_processed'] == 1
+    assert METRICS.counters['shared_cache_hits'] == 2
+
+
+def test_album_art(tmp_path):
+    settings, tracks = _tmp_library(tmp_path)
+    settings['album_art'] = 'thumb'
+    settings['thumb_dim'] = 200
+    fbase, config = list(tracks.items())[0]
+    assert build_one(fbase, config, settings)
+    out_fname = glob(op.join(settings['out_path'], '*', '*.mp3'))[0]
+    cover_fname = op.join(op.dirname(out_fname), 'cover.jpg')
+    # Full size image (smaller than out_dim) in cover file.
+    assert Image.open(cover_fname).size == Image.open(
+        op.join(HERE, 'images', 'brown_team.jpg')).size
+    thumb_data, mime = read_embedded_art(out_fname)
+    assert max(Image.open(BytesIO(thumb_data)).size) == 200
+    assert verify_tracks(tracks, settings) == {}
+    assert not build_one(fbase, config, settings)
+    # Change of setting needs a rebuild.
+    settings['album_art'] = 'none'
+    assert verify_tracks(tracks, settings)[fbase][0] == (
+        'stored params differ from inputs / config')
+    assert build_one(fbase, config, settings, force=True)
+    assert read_embedded_art(out_fname) is None
+    assert verify_tracks(tracks, settings) == {}
+    os.unlink(cover_fname)
+    assert verify_tracks(tracks, settings) == {fbase: ['missing cover.jpg']}
+    # Tracks in one folder with different images; cover from first track.
+    img_path = settings['img_paths'][0]
+    Image.open(op.join(img_path, 'brown_team.jpg')).transpose(
+        Image.FLIP_LEFT_RIGHT).save(op.join(img_path, 'disc2.jpg'))
+    shutil.copyfile(op.join(settings['wav_paths'][0], fbase),
+                    op.join(settings['wav_paths'][0], 'aclip2.wav'))
+    tracks['aclip2.wav'] = dict(config, tracknumber=2, img_fname='disc2.jpg')
+    assert build_tracks(tracks, settings) == ['aclip2.wav']
+    cover_params = stored_params_for(cover_fname)
+    assert cover_params['img_params'] == stored_params_for(
+        op.join(img_path, 'brown_team.jpg'))
+    # Cover settles.
+    assert build_tracks(tracks, settings) == []
+    assert stored_params_for(cover_fname) == cover_params
+    # Embedded art; we remove the cover file.
+    settings['album_art'] = 'embed'
+    build_tracks(tracks, settings, force=True)
+    assert not op.exists(cover_fname)
+    assert not op.exists(cover_fname + '.json')
+
+
+def test_catalog(tmp_path):
+    catalog = Catalog(str(tmp_path / 'cat' / 'catalog.sqlite'))
+    entries = {
+        'mass1.wav': {'title': 'Kyrie', 'album': 'Mass in B Minor',
+                      'composer': 'Johann Sebastian Bach',
+                      'conductor': 'Harry Christophers',
+                      'period': 'Baroque', 'style': 'Choral'},
+        'mass2.wav': {'title': 'Gloria', 'album': 'Mass in B Minor',
+                      'composer': 'Johann Sebastian Bach',
+                      'conductor': 'Harry Christophers',
+                      'period': 'Baroque', 'style': 'Choral'},
+        'vespers.wav': {'title': 'Vespers', 'album': 'Vespers',
+                        'composer': ['Claudio Monteverdi', 'Giovanni Gabrieli'],
+                        'period': 'Baroque', 'style': 'Choral'},
+        'vc.wav': {'title': 'Allegro', 'album': 'Brahms VC',
+                   'composer': 'Johannes Brahms',
+                   'period': 'Romantic', 'style': 'Concerto'},
+    }
+    for i, (track, entry) in enumerate(entries.items()):
+        out_fname = str(tmp_path / 'out' / f'{i}_{track[:-4]}.mp3')
+        _write_file(out_fname, 'audio')
+        assert catalog.update(track, entry, out_fname)
+        # Unchanged, no update.
+        assert not catalog.update(track, entry, out_fname)
+
+    def tracks_for(**criteria):
+        return [op.basename(r['out_fname']) for r in
+                catalog.query(**criteria)]
+    assert tracks_for(period='baroque', style='Choral') == [
+        '0_mass1.mp3', '1_mass2.mp3', '2_vespers.mp3']
+    assert tracks_for(composer='Giovanni Gabrieli') == ['2_vespers.mp3']
+    assert tracks_for(composer='*bach', conductor='Harry*') == [
+        '0_mass1.mp3', '1_mass2.mp3']
+    assert tracks_for(album='Eldorado') == []
+    with pytest.raises(ValueError):
+        catalog.query(foo='bar')
+    # Changed entries update the index.
+    vc_fname = catalog.query(album='Brahms VC')[0]['out_fname']
+    catalog.update('vc.wav', dict(entries['vc.wav'], period='Baroque'),
+                   vc_fname)
+    assert tracks_for(period='Romantic') == []
+    assert catalog.prune(['mass1.wav', 'mass2.wav']) == ['vc.wav',
+                                                         'vespers.wav']
+    assert tracks_for(period='baroque') == ['0_mass1.mp3', '1_mass2.mp3']
+    assert parse_query('composer=*Bach; period=Baroque') == {
+        'composer': '*Bach', 'period': 'Baroque'}
+    fobj = StringIO()
+    write_m3u(catalog.query(style='Choral'), fobj, str(tmp_path))
+    assert fobj.getvalue() == (
+        '#EXTM3U\n'
+        '#EXTINF:-1,Kyrie\n'
+        f'out{os.sep}0_mass1.mp3\n'
+        '#EXTINF:-1,Gloria\n'
+        f'out{os.sep}1_mass2.mp3\n')
+    # Relative output paths stored as absolute paths.
+    entry = dict(entries['mass1.wav'], title='Kyrie 2')
+    with pytest.MonkeyPatch.context() as mp:
+        mp.chdir(tmp_path)
+        catalog.update('mass1.wav', entry, op.join('out', '0_mass1.mp3'))
+    assert catalog.query(title='Kyrie 2')[0]['out_fname'] == str(
+        tmp_path / 'out' / '0_mass1.mp3')
+    catalog.close()
+    with pytest.raises(RuntimeError, match='No catalog'):
+        Catalog(str(tmp_path / 'no_such.sqlite'), create=False)
+
+
+def test_fetch_art(tmp_path):
+    srv_path = tmp_path / 'srv'
+    os.makedirs(srv_path / 'caa' / FUNEBRE_ID)
+    with open(op.join(HERE, 'images', 'brown_team.jpg'), 'rb') as fobj:
+        img_data = fobj.read()
+    with open(srv_path / 'caa' / FUNEBRE_ID / 'front', 'wb') as fobj:
+        fobj.write(img_data)
+    info = deepcopy(FUNEBRE_INFO)
+    info['cover-art-archive']['front'] = True
+    no_art_info = dict(FUNEBRE_INFO, id='no-art')
+    # Art listed, but missing from server, or not an image.
+    gone_info = dict(info, id='gone-art')
+    bad_info = dict(info, id='bad-art')
+    os.makedirs(srv_path / 'caa' / 'bad-art')
+    _write_file(str(srv_path / 'caa' / 'bad-art' / 'front'), 'not image')
+    for rel_id, rel_info in ((FUNEBRE_ID, info), ('no-art', no_art_info),
+                             ('gone-art', gone_info), ('bad-art', bad_info)):
+        with open(srv_path / f'{rel_id}.json', 'wt') as fobj:
+            json.dump(rel_info, fobj)
+    # Local stand-in for MusicBrainz and Cover Art Archive.
+    server = store_server(str(srv_path), ('127.0.0.1', 0))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = 'http://{}:{}'.format(*server.server_address)
+
+    class LocalMBInfo(MBInfo):
+        url_fmt = base_url + '/{release_id}.json'
+        cover_url_fmt = base_url + '/caa/{release_id}/front'
+
+    tracks = {'side1.wav': {'musicbrainz_release': FUNEBRE_ID},
+              'side2.wav': {'musicbrainz_release': FUNEBRE_ID},
+              'side3.wav': {'musicbrainz_release': FUNEBRE_ID,
+                            'img_fname': 'mine.jpg'},
+              'side4.wav': {'musicbrainz_release': 'no-art'},
+              'side5.wav': {'musicbrainz_release': 'gone-art'},
+              'side6.wav': {'musicbrainz_release': 'bad-art'}}
+    img_path = str(tmp_path / 'images')
+    METRICS.reset()
+    try:
+        new_tracks = fill_tracks(LocalMBInfo, tracks, '*', img_path=img_path)
+    finally:
+        server.shutdown()
+        server.server_close()
+    exp_fname = hashlib.md5(img_data).hexdigest() + '.jpg'
+    assert os.listdir(img_path) == [exp_fname]
+    assert new_tracks['side1.wav']['img_fname'] == exp_fname
+    assert new_tracks['side2.wav']['img_fname'] == exp_fname
+    assert new_tracks['side3.wav']['img_fname'] == 'mine.jpg'
+    for key in ('side4.wav', 'side5.wav', 'side6.wav'):
+        assert 'img_fname' not in new_tracks[key]
+    assert new_tracks['side1.wav']['album'] == info['title']
+    # Four release lookups, three image downloads.
+    assert METRICS.counters['http_requests'] == 7
+    # Unreachable image host; skip cover.
+    info = MBInfo(dict(info, id='no-host'))
+    info.cover_url_fmt = f'http://{_unused_address()}' + '/{release_id}'
+    assert fetch_art({'no-host': info}, img_path) == {}
+
+
+def test_release_dump(tmp_path):
+    dump_fname = str(tmp_path / 'releases.jsonl')
+    releases = [dict(FUNEBRE_INFO, id=f'release-{i:03d}', title=f'Album {i}')
+                for i in range(50)]
+    releases.append(FUNEBRE_INFO)
+    with open(dump_fname, 'wt') as fobj:
+        for release in releases[::-1]:
+            fobj.write(json.dumps(release) + '\n')
+        fobj.write('\n')
+    with pytest.raises(RuntimeError):
+        ReleaseDump(dump_fname)
+    assert index_dump(dump_fname) == 51
+    dump = ReleaseDump(dump_fname)
+    assert len(dump) == 51
+    assert dump.get(FUNEBRE_ID) == FUNEBRE_INFO
+    for i in (0, 1, 25, 49):
+        assert dump.get(f'release-{i:03d}')['title'] == f'Album {i}'
+    for missing in ('release-050', 'a', 'zzz'):
+        with pytest.raises(KeyError):
+            dump.get(missing)
+    tracks = {'side1.wav': {'musicbrainz_release': 'release-007'},
+              'side2.wav': {}}
+    METRICS.reset()
+    new_tracks = fill_tracks(MBInfo, tracks, '*', dump=dump)
+    assert new_tracks['side1.wav']['album'] == 'Album 7'
+    assert new_tracks['side1.wav']['conductor'] == 'Sir Colin Davis'
+    assert new_tracks['side2.wav'] == {}
+    new_tracks = fill_tracks(MBInfo, tracks, '*', FUNEBRE_ID, dump=dump)
+    assert new_tracks['side2.wav'] == MBInfo(FUNEBRE_INFO).as_config() | {
+        'musicbrainz_release': FUNEBRE_ID, 'musicbrainz_filled': True}
+    assert 'http_requests' not in METRICS.counters
+    with pytest.raises(RuntimeError,
+                       match=f'release-999 not in dump {dump_fname}'):
+        fill_tracks(MBInfo, tracks, '*', 'release-999', dump=dump)
+    # Discogs-style integer ids.
+    with open(dump_fname, 'wt') as fobj:
+        fobj.write(json.dumps({'id': 7793083, 'title': 'Palestrina'}) + '\n')
+    index_dump(dump_fname)
+    assert ReleaseDump(dump_fname).get(7793083)['title'] == 'Palestrina'
+
+
+def test_album_config(tmp_path):
+    config_fname = op.join(HERE, 'configs', 'amusic_config.yml')
+    settings, tracks = proc_config(read_config(config_fname), HERE)
+    berlioz1 = tracks['berliozfunebre1-cr.wav']
+    assert berlioz1['album'] == 'Symphonie Funèbre et Triomphale Op 15'
+    assert berlioz1['tracknumber'] == 1
+    assert tracks['berliozfunebre2-cr.wav']['tracknumber'] == 2
+    albums, singles = group_albums(tracks)
+    assert resolve_albums(albums) | singles == tracks
+    album = albums['berlioz_funebre']
+    assert album['conductor'] == 'Fritz Straub'
+    assert album['tracks']['berliozfunebre2-cr.wav'] == {
+        'title': 'Symphonie Funèbre et Triomphale Op 15: '
+        'Oraison funèbre, Apothéose',
+        'tracknumber': 2}
+    # Round trip through written config.
+    out_fname = str(tmp_path / 'config.yml')
+    write_config(settings, tracks, out_fname)
+    config = read_config(out_fname)
+    # Default settings not written.
+    assert 'album_art' not in config['settings']
+    assert proc_config(config, HERE) == (settings, tracks)
+    # Single tracks stay at top level.
+    tracks = {'aclip.wav': dict(berlioz1),
+              'other1.wav': dict(berlioz1, folder_name=None, title='One'),
+              'other2.wav': dict(berlioz1, folder_name=None, title='Two')}
+    write_config(settings, tracks, out_fname)
+    config = read_config(out_fname)
+    assert config['aclip.wav'] == berlioz1
+    assert list(config['albums']) == ['other']
+    assert proc_config(config, HERE)[1] == tracks